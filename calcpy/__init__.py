@@ -39,6 +39,10 @@ class CalcPy(IPython.core.magic.Magics):
     auto_evalf = traitlets.Bool(True, config=True, help="evalute expressions")
     auto_lambda = traitlets.Bool(True, config=True, help="convert 'f(x,y):=x+y' to 'f=lambda x,y : x+y'")
     auto_store = traitlets.Bool(True, config=True, help="enable automatic store/restore of variables and functions")
+    auto_store_write_behind = traitlets.Bool(False, config=True, help="store variables from a background thread")
+    auto_store_compress = traitlets.Bool(True, config=True, help="compress large stored variables (zstd if installed, otherwise lzma)")
+    auto_store_var_quota_mb = traitlets.Float(100, config=True, help="variables larger than this (MB) are not stored")
+    auto_store_quota_mb = traitlets.Float(1000, config=True, help="total size (MB) of stored variables")
     auto_matrix = traitlets.Bool(True, config=True, help="convert tuples of tuples to matrices")
     auto_rational = traitlets.Bool(True, config=True, help="convert integer division and floats to rationals")
     auto_date = traitlets.Bool(True, config=True, help="convert 'd\"today\"' to datetime object")
@@ -49,9 +53,18 @@ class CalcPy(IPython.core.magic.Magics):
     auto_latex_sub = traitlets.Bool(True, config=True, help="substitute local variables in parsed latex")
     uniform_assumptions = traitlets.Bool(True, config=True, help="uniform assumption per name for symbolic variables")
     previewer = traitlets.Bool(True, config=True, help="enable previewer")
+    previewer_standby = traitlets.Bool(True, config=True, help="keep a synced standby previewer, swapped in on restart")
+    previewer_skip_calls = traitlets.List(traitlets.Unicode(), config=True, help="functions not to preview, expensive or with side effects",
+        default_value=['plot', 'plot3d', 'plot_parametric', 'plot_implicit', 'plot_contour', 'plot3d_parametric_surface', 'plot3d_parametric_line',
+                       'print_info', 'run_line_magic', 'run_cell_magic', 'input', 'sleep'])
+    previewer_memory_limit_mb = traitlets.Float(4096, config=True, help="address space (MB) previewer may grow by (not counting large arrays shared with it), allocations beyond raise MemoryError, 0 for no limit")
+    previewer_cpu_limit_sec = traitlets.Float(10, config=True, help="cpu time (s) of a preview, previewer is restarted when exceeded, 0 for no limit")
+    previewer_rss_limit_mb = traitlets.Float(2048, config=True, help="previewer is restarted when its memory (MB) exceeds this, 0 for no limit")
+    previewer_trace = traitlets.Unicode('', config=True, help="path of JSONL file to trace preview timings to")
     bitwidth = traitlets.Int(0, config=True, help="bitwidth of displayed binary integers, if 0 adjusted accordingly")
     chop = traitlets.Bool(True, config=True, help="replace small numbers with zero")
     units_prefixes = traitlets.Bool(False, config=True, help="units prefixes (e.g. 2k=2000)")
+    currency_cache_ttl = traitlets.Int(12, config=True, help="hours until cached currency rates are refreshed")
     precision = property(
         lambda calcpy: calcpy.shell.run_line_magic('precision', ''),
         lambda calcpy, p: calcpy.shell.run_line_magic('precision', p))
@@ -90,6 +103,11 @@ class CalcPy(IPython.core.magic.Magics):
                 autostore.unload_ipython_extension(self.shell)
         self.observe(_auto_store_changed, names='auto_store')
 
+        def _auto_store_write_behind_changed(change):
+            if self.auto_store:
+                self.shell.autostore.set_write_behind(change.new)
+        self.observe(_auto_store_write_behind_changed, names='auto_store_write_behind')
+
         def _previewer_changed(change):
             if change.old != change.new == True:
                 self.load_previewer()
@@ -97,6 +115,16 @@ class CalcPy(IPython.core.magic.Magics):
                 self.unload_previewer()
         self.observe(_previewer_changed, names='previewer')
 
+        def _previewer_skip_calls_changed(change):
+            if getattr(self.shell, 'previewer', None):
+                self.shell.previewer.skip_calls = set(change.new)
+        self.observe(_previewer_skip_calls_changed, names='previewer_skip_calls')
+
+        def _previewer_trace_changed(change):
+            if getattr(self.shell, 'previewer', None):
+                self.shell.previewer.stats.trace_path = change.new
+        self.observe(_previewer_trace_changed, names='previewer_trace')
+
         def _units_prefixes_changed(change):
             if change.new == True:
                 self.push(self._units_prefixes_dict, interactive=False)
@@ -134,15 +162,26 @@ class CalcPy(IPython.core.magic.Magics):
 
     def reset(self, prompt=True):
         if (not prompt) or (input("Reset CalcPy configuration? [y/N] ").lower() in ["y","yes"]):
-            for trait_name, trait in sorted(self.traits(config=True).items()):
-                setattr(self, trait_name, trait.default_value)
+            for trait_name, value in sorted(self.trait_defaults(config=True).items()):
+                setattr(self, trait_name, value)
         self.shell.autostore.reset(prompt)
 
+    def autostore_stats(self):
+        '''print size and load time of each stored variable'''
+        self.shell.autostore.stats()
+
+    def previewer_stats(self):
+        '''print histograms of preview stages durations and counts of preview outcomes'''
+        self.shell.previewer.stats.print()
+
     def load_previewer(self):
         previewer_config = self.shell.config.copy()
         previewer_config.CalcPy.previewer = False
         previewer_config.CalcPy.auto_store = False
-        previewer.load_ipython_extension(self.shell, config=previewer_config, formatter=formatters.previewer_formatter, debug=self.debug)
+        previewer.load_ipython_extension(self.shell, config=previewer_config, formatter=formatters.previewer_formatter, debug=self.debug,
+                                         baseline_modules=['calcpy.user'], standby=self.previewer_standby, skip_calls=self.previewer_skip_calls,
+                                         memory_limit_mb=self.previewer_memory_limit_mb, cpu_limit_sec=self.previewer_cpu_limit_sec,
+                                         rss_limit_mb=self.previewer_rss_limit_mb, trace_path=self.previewer_trace)
 
     def unload_previewer(self):
         previewer.unload_ipython_extension(self.shell)
@@ -192,5 +231,9 @@ https://github.com/idanpa/calcpy''')
     if perf_counter() - t > USER_STARTUP_TIME_WARNING_SEC:
         print(f'User startup script took {perf_counter() - t:.3f}s!')
 
+    # restored and startup variables and functions, without waiting for the first cell
+    if getattr(ip, 'previewer', None):
+        ip.previewer.sync()
+
 if __name__ == '__main__':
     load_ipython_extension(IPython.get_ipython())
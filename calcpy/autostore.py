@@ -1,111 +1,665 @@
 import IPython
 import inspect
+import ast
 from time import perf_counter
 import os
+import zlib
+import lzma
+import pickle
+import sqlite3
+import threading
+import atexit
+import hashlib
+import marshal
+import sys
+import numpy
+from previewer import CellPickles, cell_pickles, code_names
+try:
+    import zstandard
+except (ModuleNotFoundError, ImportError):
+    zstandard = None
 
 TIME_WARNING_SEC = 2
+DB_FILE_NAME = 'autostore.sqlite'
+DB_TIMEOUT_SEC = 10
+FILES_DIR_NAME = 'autostore'
+NPY_MIN_BYTES = 1024 * 1024
+WRITE_BEHIND_DELAY_SEC = 1
+WRITE_BEHIND_MAX_BYTES = 64 * 1024 * 1024
+COMPRESS_MIN_BYTES = 256 * 1024
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+
+def fingerprint(var, pickles=None):
+    '''cheap content fingerprint to detect in place changes, None when identity is enough.
+    pickles shares pickling and crcs of the cell's values with the previewer'''
+    if pickles is None:
+        pickles = CellPickles()
+    if inspect.isfunction(var):
+        return None
+    if isinstance(var, numpy.ndarray) and not var.dtype.hasobject:
+        return (var.shape, var.dtype.str, pickles.crc(var))
+    if type(var).__hash__ not in [None, object.__hash__]:
+        try:
+            return hash(var) # immutable
+        except TypeError:
+            pass
+    pickled = pickles.dumps(var)
+    return None if isinstance(pickled, Exception) else zlib.crc32(pickled)
+
+def is_changed(var, stored, pickles):
+    '''whether var changed since it was stored as (var, fingerprint), fingerprinted only if it may have changed in place'''
+    stored_var, stored_fingerprint = stored
+    if var is not stored_var:
+        return True
+    if isinstance(var, numpy.ndarray) and stored_fingerprint is not None and \
+     stored_fingerprint[:2] != (var.shape, var.dtype.str):
+        return True # resized
+    return fingerprint(var, pickles) != stored_fingerprint
+
+def dumps(var, compress=False, pickles=None):
+    '''pickles var, large pickles are compressed with zstd if available, otherwise lzma'''
+    if pickles is None:
+        data = pickle.dumps(var)
+    else:
+        data = pickles.dumps(var)
+        if isinstance(data, Exception):
+            raise data
+    if compress and len(data) >= COMPRESS_MIN_BYTES:
+        if zstandard is not None:
+            compressed = zstandard.ZstdCompressor().compress(data)
+        else:
+            compressed = lzma.compress(data, preset=1)
+        if len(compressed) < len(data):
+            return compressed
+    return data
+
+def loads(data):
+    '''unpickles data of dumps, compression is detected by magic bytes (pickles start with 0x80)'''
+    if data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ModuleNotFoundError('zstandard is needed to restore zstd compressed variable')
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif data.startswith(XZ_MAGIC):
+        data = lzma.decompress(data)
+    return pickle.loads(data)
+
+class AutostoreDB():
+    '''Pickled variables in a single sqlite file, each batch of changes is written in one transaction.
+    WAL journal allows concurrent calcpy sessions to read and write the same file'''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=DB_TIMEOUT_SEC, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS vars (name TEXT PRIMARY KEY, value BLOB NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS code (key TEXT PRIMARY KEY, code BLOB NOT NULL)')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT name FROM vars')]
+
+    def items(self, prefix=''):
+        with self.lock:
+            return self.conn.execute('SELECT name, value FROM vars WHERE substr(name, 1, ?)=?',
+                                     (len(prefix), prefix)).fetchall()
+
+    def __getitem__(self, name):
+        return loads(self.pickled(name))
+
+    def pickled(self, name):
+        '''stored bytes of name, as written'''
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM vars WHERE name=?', (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return row[0]
+
+    def sizes(self):
+        with self.lock:
+            return dict(self.conn.execute('SELECT name, length(value) FROM vars').fetchall())
+
+    def write(self, changed={}, deleted=[], replace=True):
+        '''changed is {name: pickled value}, deleted is [name], all in a single transaction'''
+        if not changed and not deleted:
+            return
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany(f'INSERT OR {"REPLACE" if replace else "IGNORE"} INTO vars VALUES (?, ?)', changed.items())
+                self.conn.executemany('DELETE FROM vars WHERE name=?', [(name,) for name in deleted])
+                self.conn.execute('COMMIT')
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM vars')
+
+    def codes(self):
+        with self.lock:
+            return dict(self.conn.execute('SELECT key, code FROM code').fetchall())
+
+    def write_codes(self, codes):
+        '''replaces compiled code cache with {key: marshaled code}'''
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute('DELETE FROM code')
+                self.conn.executemany('INSERT INTO code VALUES (?, ?)', codes.items())
+                self.conn.execute('COMMIT')
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def user_version(self, version=None):
+        with self.lock:
+            if version is not None:
+                self.conn.execute(f'PRAGMA user_version={int(version)}')
+            return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+class WriteBehind():
+    '''Writes from a background thread. Pending writes to the same name are coalesced,
+    each flush is a single db transaction so the db always holds the state after some cell'''
+    def __init__(self, write, delay=WRITE_BEHIND_DELAY_SEC, max_bytes=WRITE_BEHIND_MAX_BYTES):
+        self.write_now = write # write(changed, deleted, arrays)
+        self.delay = delay
+        self.max_bytes = max_bytes
+        self.pending = {} # name: (pickled value or None for deletion, array to save as .npy or None)
+        self.pending_bytes = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock() # keeps batches in order
+        self.thread = threading.Thread(target=self.run, name='autostore-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def size(entry):
+        value, array = entry
+        return len(value or b'') + (0 if array is None else array.nbytes)
+
+    def write(self, changed={}, deleted=[], arrays={}):
+        with self.cond:
+            for name, value in [(name, None) for name in deleted] + list(changed.items()):
+                if name in self.pending:
+                    self.pending_bytes -= self.size(self.pending.pop(name))
+                array = arrays.get(name)
+                # snapshot, the variable may be changed in place before it's written
+                self.pending[name] = (value, None if array is None else array.copy())
+                self.pending_bytes += self.size(self.pending[name])
+            self.cond.notify()
+            over_limit = self.pending_bytes > self.max_bytes
+        if over_limit:
+            self.flush() # applies back pressure instead of growing
+
+    def flush(self):
+        with self.flush_lock:
+            with self.cond:
+                pending, self.pending, self.pending_bytes = self.pending, {}, 0
+            try:
+                self.write_now({name: value for name, (value, array) in pending.items() if value is not None},
+                               [name for name, (value, array) in pending.items() if value is None],
+                               {name: array for name, (value, array) in pending.items() if array is not None})
+            except:
+                # retried with the next flush, names written meanwhile keep their newer value
+                with self.cond:
+                    for name, entry in pending.items():
+                        if name not in self.pending:
+                            self.pending[name] = entry
+                            self.pending_bytes += self.size(entry)
+                raise
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.closed)
+                if self.closed:
+                    return
+                self.cond.wait_for(lambda: self.closed, timeout=self.delay)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f'Autostore: failed to write {repr(e)}')
+
+    def close(self):
+        atexit.unregister(self.close)
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        self.flush()
+
+class NpyFile():
+    '''db entry of a large array stored in its own .npy file'''
+
+def load_stored(data, npy_path):
+    '''value of a db entry, large arrays are mapped read only'''
+    var = loads(data)
+    if isinstance(var, NpyFile):
+        var = numpy.load(npy_path, mmap_mode='r')
+    return var
+
+class LazyVar():
+    '''placeholder of a stored variable, unpickled on first access'''
+    def __init__(self, autostore, var_name):
+        self._autostore = autostore
+        self._var_name = var_name
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') and attr.endswith('__'):
+            raise AttributeError(attr) # protocol probes (e.g. hasattr(var, '__float__')) don't load
+        return getattr(self._autostore.load(self._var_name), attr)
+
+    def __repr__(self):
+        return repr(self._autostore.load(self._var_name))
+
+    def __str__(self):
+        return str(self._autostore.load(self._var_name))
+
+    def __hash__(self):
+        # never changes in place, replaced in the namespace when loaded
+        return hash((LazyVar, self._var_name))
+
+    def __reduce__(self):
+        # pickled as the stored bytes (e.g. to previewer), unpickled only by whoever loads it
+        return load_stored, (self._autostore.db.pickled(self._var_name), self._autostore.npy_path(self._var_name))
+
+def loaded(var):
+    '''value of a variable, placeholders of stored variables are loaded'''
+    if isinstance(var, LazyVar):
+        return var._autostore.load(var._var_name)
+    return var
+
+class LoadLazyVars(ast.NodeVisitor):
+    '''loads stored variables referenced in a cell before it is transformed and executed'''
+    def __init__(self, autostore):
+        super().__init__()
+        self.autostore = autostore
+
+    def visit_Name(self, node):
+        self.autostore.load(node.id)
+
+    def visit(self, node):
+        if not self.autostore.lazy_vars:
+            return node
+        super().visit(node)
+        return node
 
 class Autostore():
     def __init__(self, shell, verbose=False):
         t = perf_counter()
         self.shell = shell
         self.verbose = verbose
-        self.last_user_ns = []
+        # var_name: (var, fingerprint) of stored variables
+        self.stored = {}
+        # var_name: LazyVar of stored variables not loaded yet
+        self.lazy_vars = {}
+        # var_name: memmap of the variable's .npy file, in place changes are written directly
+        self.mapped = {}
+        self.files_dir = os.path.join(self.shell.profile_dir.location, FILES_DIR_NAME)
+        os.makedirs(self.files_dir, exist_ok=True)
+        # db key: seconds it took to unpickle
+        self.load_times = {}
+        # var_name of variables not stored due to quota, checked again only when reassigned
+        self.skipped = set()
 
+        self.db = AutostoreDB(os.path.join(self.shell.profile_dir.location, DB_FILE_NAME))
+        if self.db.user_version() == 0:
+            self.migrate_pickleshare()
+            self.db.user_version(1)
+
+        # db key: serialized size in bytes (of .npy file for large arrays)
+        self.sizes = self.db.sizes()
+        for var_name in self.sizes:
+            if os.path.isfile(self.npy_path(var_name)):
+                self.sizes[var_name] = os.path.getsize(self.npy_path(var_name))
+
+        self.writer = self # or WriteBehind of self.write
+        self.set_write_behind(self.shell.calcpy.auto_store_write_behind)
         self.shell.events.register('post_run_cell', self.post_run_cell)
 
-        for var_path in self.shell.db.keys('autostore/*'):
-            var_name = os.path.basename(var_path)
-            try:
-                var = self.shell.db[var_path]
-            except KeyError as e:
-                print(f'Autostore: failed to restore "{var_name}" {repr(e)}')
-                del self.shell.db[var_path]
-                continue
+        # variables are only registered here, unpickled when first used
+        for var_name in self.db.keys():
             if var_name.startswith('_func_'):
-                # to allow %edit func_name, need to place function in file
-                file_path = self.shell.mktempfile(var, prefix='autostore' + var_name + '_')
-                try:
-                    self.shell.safe_execfile(file_path, shell.user_ns, shell_futures=True, raise_exceptions=True)
-                except Exception as e:
-                    print(f'Autostore: failed to restore function\n{var}\n{repr(e)}')
-                    del self.shell.db[var_path]
-                try:
-                    self.shell.previewer.run_cell(var)
-                except AttributeError:
-                    pass
+                continue
+            if var_name in self.shell.user_ns:
+                print(f'Autostore: attempt to restore existing variable "{var_name}"')
+                self.db.write(deleted=[var_name])
             else:
-                if var_name in self.shell.user_ns:
-                    print(f'Autostore: attempt to restore existing variable "{var_name}"')
-                    del self.shell.db[var_path]
-                else:
-                    self.shell.user_ns[var_name] = var
+                self.lazy_vars[var_name] = LazyVar(self, var_name)
+                self.shell.user_ns[var_name] = self.lazy_vars[var_name]
+        self.lazy_loader = LoadLazyVars(self)
+        self.shell.ast_transformers.insert(0, self.lazy_loader)
+
+        self.restore_functions()
         if perf_counter() - t > TIME_WARNING_SEC:
             print(f'Autostore took {perf_counter() - t:.3f}s! consider clearing unused vars')
 
+    def restore_functions(self):
+        '''executes all stored functions, compiled code is cached per source and python version'''
+        func_dir = self.files_dir
+        cached_codes = self.db.codes()
+        codes = {}
+        for var_name, pickled_var in self.db.items('_func_'):
+            func_name = var_name.removeprefix('_func_')
+            try:
+                t = perf_counter()
+                source = loads(pickled_var)
+                # to allow %edit func_name, need to place function in file
+                file_path = os.path.join(func_dir, f'autostore_func_{func_name}.py')
+                try:
+                    with open(file_path, 'r', encoding='utf-8') as f:
+                        file_outdated = f.read() != source
+                except OSError:
+                    file_outdated = True
+                if file_outdated:
+                    with open(file_path, 'w', encoding='utf-8') as f:
+                        f.write(source)
+                key = hashlib.sha256(f'{file_path}\0{source}'.encode()).hexdigest() + sys.implementation.cache_tag
+                if key in cached_codes:
+                    code = marshal.loads(cached_codes[key])
+                else:
+                    code = compile(source, file_path, 'exec', flags=self.shell.compile.flags, dont_inherit=True)
+                codes[key] = marshal.dumps(code)
+                exec(code, self.shell.user_ns)
+                self.stored[func_name] = (self.shell.user_ns[func_name], None)
+                self.load_times[var_name] = perf_counter() - t
+                # globals used by the function are not seen by the lazy loader
+                for name in code_names(code) & self.lazy_vars.keys():
+                    self.load(name)
+            except ImportError as e:
+                print(f'Autostore: function "{func_name}" not restored {repr(e)}')
+            except Exception as e:
+                print(f'Autostore: failed to restore function "{func_name}" {repr(e)}')
+                self.db.write(deleted=[var_name])
+        if codes != cached_codes:
+            self.db.write_codes(codes)
+        # previewer gets the functions' sources with its next namespace sync, done right after extension load
+
+    def set_write_behind(self, enable):
+        if enable and self.writer is self:
+            self.writer = WriteBehind(self.write)
+        if not enable and self.writer is not self:
+            self.writer.close()
+            self.writer = self
+
     def unload(self):
         self.shell.events.unregister('post_run_cell', self.post_run_cell)
+        self.set_write_behind(False)
+        self.shell.ast_transformers.remove(self.lazy_loader)
+        # variables stay in the namespace without the db
+        for var_name in list(self.lazy_vars):
+            self.load(var_name)
+        self.db.close()
 
-    def store(self, var_name, verbose=True):
+    def load(self, var_name):
+        '''unpickles a stored variable that was not used yet, returns its value'''
+        lazy_var = self.lazy_vars.pop(var_name, None)
+        if lazy_var is None:
+            return self.shell.user_ns.get(var_name)
+        try:
+            t = perf_counter()
+            var = self.db[var_name]
+            if isinstance(var, NpyFile):
+                var = numpy.load(self.npy_path(var_name), mmap_mode='r+')
+            self.load_times[var_name] = perf_counter() - t
+        except ImportError as e:
+            # e.g. compressed by a session with zstandard, entry is kept for it
+            print(f'Autostore: "{var_name}" not restored {repr(e)}')
+            if self.shell.user_ns.get(var_name) is lazy_var:
+                del self.shell.user_ns[var_name]
+            return None
+        except Exception as e:
+            print(f'Autostore: failed to restore "{var_name}" {repr(e)}')
+            self.db.write(deleted=[var_name])
+            if self.shell.user_ns.get(var_name) is lazy_var:
+                del self.shell.user_ns[var_name]
+            return None
+        if self.shell.user_ns.get(var_name) is lazy_var:
+            self.shell.user_ns[var_name] = var
+            if isinstance(var, numpy.memmap):
+                self.mapped[var_name] = var
+                self.stored[var_name] = (var, None)
+            else:
+                self.stored[var_name] = (var, fingerprint(var))
+        return var
+
+    def npy_path(self, var_name):
+        return os.path.join(self.files_dir, var_name + '.npy')
+
+    def save_npy(self, var_name, var):
+        npy_path = self.npy_path(var_name)
+        tmp_path = npy_path + '.tmp'
+        numpy.save(tmp_path, var, allow_pickle=False)
+        os.replace(tmp_path + '.npy', npy_path) # numpy.save appends the extension
+
+    def remove_npy(self, var_name):
+        try:
+            os.remove(self.npy_path(var_name))
+        except FileNotFoundError:
+            pass
+        except OSError as e: # might still be mapped on windows
+            print(f'Autostore: failed to remove "{self.npy_path(var_name)}" {repr(e)}')
+
+    def migrate_pickleshare(self):
+        # one time migration of variables stored by previous versions, one file per variable in shell.db
+        # entries that can't be read or unpickled are left in shell.db, to be recovered by hand
+        var_paths = self.shell.db.keys('autostore/*')
+        changed = {}
+        migrated = []
+        for var_path in var_paths:
+            try:
+                data = (self.shell.db.root / var_path).read_bytes()
+                loads(data)
+            except Exception as e:
+                print(f'Autostore: failed to migrate "{var_path}", left in {self.shell.db.root} {repr(e)}')
+                continue
+            changed[os.path.basename(var_path)] = data
+            migrated.append(var_path)
+        # don't override variables stored meanwhile by another session
+        self.db.write(changed, replace=False)
+        for var_path in migrated:
+            self.shell.db.pop(var_path, None)
+
+    def write(self, changed={}, deleted=[], arrays={}):
+        '''writes .npy files of arrays, then the rows in one transaction, then removes .npy files of
+        the other names, so a row never refers to a missing file'''
+        changed = dict(changed)
+        saved = set()
+        for var_name, var in arrays.items():
+            try:
+                self.save_npy(var_name, var)
+                saved.add(var_name)
+            except Exception as e:
+                print(f'Failed to store {var_name} as .npy: {repr(e)}')
+                changed[var_name] = dumps(var, compress=self.shell.calcpy.auto_store_compress)
+        self.db.write(changed, deleted)
+        for var_name in [*changed, *deleted]:
+            if var_name not in saved and os.path.isfile(self.npy_path(var_name)):
+                self.remove_npy(var_name)
+
+    def serialize(self, var_name, verbose=True, pickles=None):
+        '''returns (db key, pickled variable, size, array to save as .npy or None), or None if variable should not be stored'''
         var = self.shell.user_ns[var_name]
         if inspect.isbuiltin(var) or inspect.ismodule(var) or inspect.isclass(var):
-            return False
+            return None
         if inspect.isfunction(var):
             # skip external functions:
             var_file = inspect.getfile(var)
             if not (var_file.startswith('<ipython-input-') or ('autostore_func_' in var_file) or ('ipython_edit_' in var_file)):
-                return False
+                return None
             try:
                 var = inspect.getsource(var)
             except Exception as e:
                 print(f'Failed to get function source {var_name}: {repr(e)}')
-                return False
+                return None
             var_name = '_func_' + var_name
+            pickles = None # source isn't a user variable
+
+        if isinstance(var, numpy.ndarray) and not var.dtype.hasobject and var.nbytes >= NPY_MIN_BYTES:
+            if self.over_var_quota(var_name, var.nbytes):
+                return None
+            # file is written with the row, an in place change meanwhile is stored again by the next cell
+            return var_name, pickle.dumps(NpyFile()), var.nbytes, numpy.asarray(var)
 
-        var_path = 'autostore/' + var_name
         try:
-            self.shell.db[var_path] = var
+            pickled_var = dumps(var, compress=self.shell.calcpy.auto_store_compress, pickles=pickles)
         except Exception as e:
             if verbose:
                 print(f'Failed to store {var_name}={var} of type {type(var)}: {repr(e)}')
-            del self.shell.db[var_path]
+            return None
+        if self.over_var_quota(var_name, len(pickled_var)):
+            return None
+        return var_name, pickled_var, len(pickled_var), None
+
+    def over_var_quota(self, var_name, size):
+        quota_mb = self.shell.calcpy.auto_store_var_quota_mb
+        if size > quota_mb * 2**20:
+            self.skipped.add(var_name.removeprefix('_func_'))
+            print(f'Autostore: "{var_name.removeprefix("_func_")}" not stored, {size / 2**20:.1f}MB is over auto_store_var_quota_mb={quota_mb}')
+            return True
+        return False
+
+    def over_total_quota(self, key, size, sizes):
+        '''sizes are of the stored variables, without key's previous value'''
+        quota_mb = self.shell.calcpy.auto_store_quota_mb
+        total = sum(sizes.values()) + size
+        if total > quota_mb * 2**20:
+            self.skipped.add(key.removeprefix('_func_'))
+            print(f'Autostore: "{key.removeprefix("_func_")}" not stored, total of {total / 2**20:.1f}MB would be over auto_store_quota_mb={quota_mb}')
+            return True
+        return False
+
+    def stats(self):
+        '''prints serialized size and load time of each stored variable'''
+        if self.writer is not self:
+            self.writer.flush()
+        rows = sorted(self.sizes.items(), key=lambda item: -item[1])
+        name_width = max([len(key) for key, size in rows] + [len('Variable')])
+        print(f'{"Variable":<{name_width}}  {"Size":>10}  {"Load time":>10}')
+        for key, size in rows:
+            if key in self.load_times:
+                load_time = f'{self.load_times[key]*1000:.1f}ms'
+            else:
+                load_time = 'not loaded' if key in self.lazy_vars else ''
+            npy = ' (.npy)' if os.path.isfile(self.npy_path(key)) else ''
+            print(f'{key.removeprefix("_func_"):<{name_width}}  {size / 1024:>8.1f}KB  {load_time:>10}{npy}')
+        print(f'{"Total":<{name_width}}  {sum(self.sizes.values()) / 1024:>8.1f}KB  {sum(self.load_times.values())*1000:>8.1f}ms')
+
+    def store(self, var_name, verbose=True):
+        serialized = self.serialize(var_name, verbose)
+        if serialized is None:
+            self.remove(var_name)
             return False
+        key, pickled_var, size, array = serialized
+        # variable might have been a function before (or vice versa)
+        other_key = var_name if key != var_name else '_func_' + var_name
+        sizes = {k: v for k, v in self.sizes.items() if k not in [key, other_key]}
+        if self.over_total_quota(key, size, sizes):
+            self.remove(var_name)
+            return False
+        self.mapped.pop(var_name, None)
+        self.writer.write({key: pickled_var}, [other_key], {} if array is None else {key: array})
+        self.sizes = {**sizes, key: size}
         return True
 
     def remove(self, var_name, verbose=True):
-        self.shell.db.pop('autostore/' + var_name, None)
-        self.shell.db.pop('autostore/_func_' + var_name, None)
+        self.mapped.pop(var_name, None)
+        self.writer.write(deleted=[var_name, '_func_' + var_name])
+        self.sizes.pop(var_name, None)
+        self.sizes.pop('_func_' + var_name, None)
 
-    def store_all_user_vars(self):
-        new_last_user_ns = []
+    def store_all_user_vars(self, pickles=None):
+        # store only variables that were assigned or changed since last store, all in one transaction
+        if pickles is None:
+            pickles = CellPickles()
+        stored = {}
+        changed = {}
+        deleted = []
+        arrays = {}
+        sizes = dict(self.sizes)
         for var_name in list(self.shell.user_ns):
+            var = self.shell.user_ns[var_name]
             if var_name.startswith('_') or \
-             self.shell.user_ns[var_name] is \
-              self.shell.user_ns_hidden.get(var_name, None):
+             var is self.shell.user_ns_hidden.get(var_name, None):
+                continue
+            if isinstance(var, LazyVar):
+                if var is self.lazy_vars.get(var_name):
+                    continue # not loaded, unchanged
+                var = self.shell.user_ns[var_name] = self.load(var._var_name)
+            if var is self.mapped.get(var_name):
+                var.flush() # in place changes are already in the file
+                stored[var_name] = self.stored[var_name]
                 continue
-            self.store(var_name, verbose=self.verbose)
-            new_last_user_ns.append(var_name)
-            if var_name in self.last_user_ns:
-                self.last_user_ns.remove(var_name)
+            if var_name in self.skipped and self.stored.get(var_name, (None,))[0] is var:
+                stored[var_name] = self.stored[var_name]
+                continue
+            if var_name in self.stored and self.stored[var_name][0] is var and not pickles.is_touched(var_name):
+                stored[var_name] = self.stored[var_name]
+                continue
+            self.skipped.discard(var_name)
+            if var_name not in self.stored or is_changed(var, self.stored[var_name], pickles):
+                serialized = self.serialize(var_name, verbose=self.verbose, pickles=pickles)
+                if serialized is not None:
+                    key, pickled_var, size, array = serialized
+                    other_key = var_name if key != var_name else '_func_' + var_name
+                    sizes.pop(key, None)
+                    sizes.pop(other_key, None)
+                    if self.over_total_quota(key, size, sizes):
+                        serialized = None
+                if serialized is None:
+                    deleted += [var_name, '_func_' + var_name]
+                    sizes.pop(var_name, None)
+                    sizes.pop('_func_' + var_name, None)
+                else:
+                    changed[key] = pickled_var
+                    deleted.append(other_key)
+                    sizes[key] = size
+                    if array is not None:
+                        arrays[key] = array
+            stored[var_name] = (var, fingerprint(var, pickles))
 
-        for var_name in self.last_user_ns:
-            self.remove(var_name)
-        self.last_user_ns = new_last_user_ns
+        for var_name in self.stored.keys() - stored.keys():
+            deleted += [var_name, '_func_' + var_name]
+            self.skipped.discard(var_name)
+        for var_name, lazy_var in list(self.lazy_vars.items()):
+            if self.shell.user_ns.get(var_name) is not lazy_var:
+                # deleted or reassigned before ever loaded
+                del self.lazy_vars[var_name]
+                if var_name not in stored:
+                    deleted += [var_name, '_func_' + var_name]
+        for var_name in [*changed, *deleted]:
+            self.mapped.pop(var_name, None)
+        self.writer.write(changed, deleted, arrays)
+        self.stored = stored
+        self.sizes = {key: size for key, size in sizes.items() if key not in deleted or key in changed}
 
     def post_run_cell(self, result):
-        self.store_all_user_vars()
+        self.store_all_user_vars(cell_pickles(self.shell, result))
 
     def _get_stored(self):
-        return [os.path.basename(var_path).removeprefix('_func_') for \
-                var_path in self.shell.db.keys('autostore/*')]
+        if self.writer is not self:
+            self.writer.flush()
+        return [var_name.removeprefix('_func_') for var_name in self.db.keys()]
 
     def reset(self, prompt=True):
         if prompt:
             if input("Delete all variables [y/N] ").lower() not in ["y","yes"]:
                 return
-        for var_path in self.shell.db.keys('autostore/*'):
-            self.shell.db.pop(var_path, None)
-            self.shell.user_ns.pop(os.path.basename(var_path).removeprefix('_func_'), None)
+        for var_name in self._get_stored():
+            self.shell.user_ns.pop(var_name, None)
+            if os.path.isfile(self.npy_path(var_name)):
+                self.remove_npy(var_name)
+        self.mapped.clear()
+        self.lazy_vars.clear()
+        self.sizes = {}
+        self.db.clear()
 
 def load_ipython_extension(ip:IPython.InteractiveShell, verbose=False):
     ip.autostore = Autostore(ip, verbose=verbose)
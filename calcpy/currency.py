@@ -1,8 +1,17 @@
+import os
+import io
+import re
+import locale
+import zipfile
+import datetime
 import requests
+import requests.adapters
+from concurrent.futures import ThreadPoolExecutor
 from xml.etree import ElementTree
 import IPython
 import sympy
-from time import sleep
+import numpy as np
+from time import sleep, time
 
 country_to_currency = {
     # ISO2 country code, currency # country name ISO3 currency name
@@ -258,6 +267,21 @@ SUPPORTED_CURRENCIES = sorted(['EUR', 'USD', 'JPY', 'BGN', 'CZK', 'DKK', 'GBP',
 
 BASE_CURRENCY_VAR_PATH = 'calcpy/base_currency'
 COMMON_CURRENCIES_VAR_PATH = 'calcpy/common_currencies'
+RATES_VAR_PATH = 'calcpy/currency_rates'
+
+IPINFO_URL = 'http://ipinfo.io/json'
+ECB_DAILY_URL = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-daily.xml'
+ECB_HIST_URL = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip'
+ECB_HIST_90D_URL = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist-90d.xml'
+ECB_NS_CUBE = '{http://www.ecb.int/vocabulary/2002-08-01/eurofxref}Cube'
+BINANCE_PRICE_URL = 'https://api.binance.com/api/v3/ticker/price'
+UPDATE_RETRY_SEC = 60*10
+FETCH_TIMEOUT_SEC = 5
+BASE_CURRENCY_TIMEOUT_SEC = 3
+
+HISTORY_FILE_NAME = 'currency_history.npz'
+
+_session = None
 
 def check_currency(curr):
     if curr not in SUPPORTED_CURRENCIES:
@@ -268,17 +292,43 @@ def set_base_currency(calcpy, base_curr, update=True):
     check_currency(base_curr)
     calcpy.shell.db[BASE_CURRENCY_VAR_PATH] = base_curr
     if update:
-        update_currency(calcpy)
+        push_cached_rates(calcpy) or update_currency(calcpy)
+
+def guess_base_currency():
+    '''base currency by locale settings (e.g. LANG=en_US.UTF-8), no network access'''
+    locale_names = [os.environ.get(env_var, '') for env_var in ['LC_ALL', 'LC_MONETARY', 'LANG']]
+    try:
+        locale_names.append(locale.getlocale(locale.LC_MONETARY)[0] or '')
+    except (ValueError, AttributeError):
+        pass
+    for locale_name in locale_names:
+        match = re.match(r'[a-zA-Z]{2,3}_([A-Z]{2})\b', locale_name)
+        if match and country_to_currency.get(match[1]) in SUPPORTED_CURRENCIES:
+            return country_to_currency[match[1]]
+    return 'USD'
+
+def lookup_base_currency_job(calcpy, guessed_curr):
+    try:
+        resp = get_session().get(IPINFO_URL, timeout=BASE_CURRENCY_TIMEOUT_SEC)
+        resp.raise_for_status()
+        base_curr = country_to_currency.get(resp.json()['country'], 'USD')
+        if base_curr not in SUPPORTED_CURRENCIES:
+            base_curr = 'USD'
+        # user might have set base currency meanwhile
+        if BASE_CURRENCY_VAR_PATH not in calcpy.shell.db:
+            set_base_currency(calcpy, base_curr, update=(base_curr != guessed_curr))
+    except Exception as e:
+        if calcpy.debug:
+            print(f'Base currency lookup failed: {e}')
 
 def get_base_currency(calcpy):
     if BASE_CURRENCY_VAR_PATH in calcpy.shell.db:
         return calcpy.shell.db[BASE_CURRENCY_VAR_PATH]
 
-    resp = requests.get('http://ipinfo.io/json')
-    country = resp.json()['country']
-    base_curr = country_to_currency.get(country, 'USD')
-
-    set_base_currency(calcpy, base_curr, update=False)
+    # use local guess until lookup by ip address is done, stored only when lookup succeeds
+    base_curr = guess_base_currency()
+    if getattr(calcpy, '_base_currency_lookup_job', None) is None: # once per session
+        calcpy._base_currency_lookup_job = calcpy.jobs.new(lookup_base_currency_job, calcpy, base_curr, daemon=True)
 
     return base_curr
 
@@ -288,7 +338,7 @@ def set_common_currencies(calcpy, comm_currs, update=True):
         check_currency(curr)
     calcpy.shell.db[COMMON_CURRENCIES_VAR_PATH] = comm_currs
     if update:
-        update_currency(calcpy)
+        push_cached_rates(calcpy) or update_currency(calcpy)
 
 def get_common_currencies(calcpy):
     if COMMON_CURRENCIES_VAR_PATH in calcpy.shell.db:
@@ -299,52 +349,281 @@ def get_common_currencies(calcpy):
 
     return comm_currs
 
+def get_session():
+    # one pooled session, connections are kept alive between (concurrent) requests
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=len(CRYPTO_CURRENCIES)+1)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+def parse_ecb_xml(content):
+    '''{time: {curr: rate}} of all days in ECB eurofxref xml'''
+    days = {}
+    for element in ElementTree.fromstring(content).find(ECB_NS_CUBE).findall(ECB_NS_CUBE):
+        rates = {'EUR': 1.00}
+        for child in element.findall(ECB_NS_CUBE):
+            rates[child.attrib['currency']] = float(child.attrib['rate'])
+        days[element.attrib['time']] = rates
+    return days
+
+def parse_ecb_csv_zip(content):
+    '''{time: {curr: rate}} of all days in ECB eurofxref-hist.zip'''
+    with zipfile.ZipFile(io.BytesIO(content)) as zip_file:
+        lines = zip_file.read(zip_file.namelist()[0]).decode().splitlines()
+    header = [field.strip() for field in lines[0].split(',')]
+    days = {}
+    for line in lines[1:]:
+        fields = [field.strip() for field in line.split(',')]
+        rates = {'EUR': 1.00}
+        for curr, rate in zip(header[1:], fields[1:]):
+            if curr and rate not in ['', 'N/A']:
+                rates[curr] = float(rate)
+        days[fields[0]] = rates
+    return days
+
+def get_ecb_rates(session):
+    resp = session.get(ECB_DAILY_URL, timeout=FETCH_TIMEOUT_SEC)
+    resp.raise_for_status()
+    days = parse_ecb_xml(resp.content)
+    rates_time = max(days)
+    return rates_time, days[rates_time]
+
+def get_crypto_rate(session, crypto_curr):
+    resp = session.get(BINANCE_PRICE_URL, params={'symbol': f'{crypto_curr}EUR'}, timeout=FETCH_TIMEOUT_SEC)
+    resp.raise_for_status()
+    return 1/float(resp.json()['price'])
+
 def get_rates():
-    ns_cube = '{http://www.ecb.int/vocabulary/2002-08-01/eurofxref}Cube'
-    resp = requests.get('https://www.ecb.europa.eu/stats/eurofxref/eurofxref-daily.xml')
-    element = ElementTree.fromstring(resp.content).find(ns_cube).find(ns_cube)
-    time = element.attrib['time']
-    rates = {'EUR': 1.00}
-    for child in element.findall(ns_cube):
-        rates[child.attrib['currency']] = float(child.attrib['rate'])
+    '''fetch all rates concurrently, crypto currencies that failed are missing from the result'''
+    session = get_session()
+    with ThreadPoolExecutor(max_workers=len(CRYPTO_CURRENCIES)+1, thread_name_prefix='currency') as pool:
+        ecb_future = pool.submit(get_ecb_rates, session)
+        crypto_futures = {cc: pool.submit(get_crypto_rate, session, cc) for cc in CRYPTO_CURRENCIES}
+        rates_time, rates = ecb_future.result()
+        for cc, future in crypto_futures.items():
+            try:
+                rates[cc] = future.result()
+            except Exception as e:
+                if IPython.get_ipython().calcpy.debug:
+                    print(f'Crypto currency {cc} fetch failed: {e}')
+    return rates_time, rates
+
+def get_cached_rates(calcpy):
+    '''last fetched rates as {'time': ecb date, 'timestamp': fetch time, 'rates': {curr: rate}}, None if never fetched'''
     try:
-        for cc in CRYPTO_CURRENCIES:
-            rates[cc] = 1/float(requests.get(f'https://api.binance.com/api/v3/ticker/price?symbol={cc}EUR')
-                .json()['price'])
+        return calcpy.shell.db[RATES_VAR_PATH]
+    except KeyError:
+        return None
+
+def set_cached_rates(calcpy, rates_time, rates):
+    calcpy.shell.db[RATES_VAR_PATH] = {'time': rates_time, 'timestamp': time(), 'rates': rates}
+
+def set_conversion_matrix(calcpy, rates):
+    # conversion_matrix[from, to] is the float factor converting amounts of 'from' to 'to'
+    currs = sorted(rates)
+    values = np.array([rates[curr] for curr in currs], dtype=float)
+    calcpy._currency_index = {curr: idx for idx, curr in enumerate(currs)}
+    calcpy._currency_matrix = values[np.newaxis, :] / values[:, np.newaxis]
+
+def conversion_factor(calcpy, from_curr, to_curr):
+    from_curr, to_curr = from_curr.upper(), to_curr.upper()
+    check_currency(from_curr)
+    check_currency(to_curr)
+    index = getattr(calcpy, '_currency_index', {})
+    for curr in [from_curr, to_curr]:
+        if curr not in index:
+            raise ValueError(f'No rate available for "{curr}", update by calcpy.update_currency()')
+    return calcpy._currency_matrix[index[from_curr], index[to_curr]]
+
+def convert(calcpy, amounts, from_curr, to_curr=None):
+    '''Convert amounts (number or array) from one currency to another (base currency by default), e.g.
+    calcpy.convert(np.array([10, 20]), 'USD', 'EUR')'''
+    if to_curr is None:
+        to_curr = calcpy.base_currency
+    converted = np.asarray(amounts, dtype=float) * conversion_factor(calcpy, from_curr, to_curr)
+    if converted.ndim == 0:
+        return float(converted)
+    return converted
+
+def push_rates(calcpy, rates, full=False):
+    base_curr = calcpy.base_currency
+    comm_currs = list(filter(base_curr.__ne__, calcpy.common_currencies))
+    last_base_curr, last_comm_currs, last_rates = getattr(calcpy, '_pushed_currency', (None, None, {}))
+    if full or (last_base_curr, last_comm_currs) != (base_curr, comm_currs):
+        last_rates = {}
+    # all variables are relative to base currency, if its rate changed everything changed
+    base_changed = rates[base_curr] != last_rates.get(base_curr)
+    changed_currs = [curr for curr in rates if base_changed or rates[curr] != last_rates.get(curr)]
+    if not changed_currs:
+        return
+
+    set_conversion_matrix(calcpy, rates)
+    index, matrix = calcpy._currency_index, calcpy._currency_matrix
+    base_idx = index[base_curr]
+    rates_vars = {}
+    for curr in changed_currs:
+        rates_vars[curr] = rates_vars[curr.lower()] = float(matrix[index[curr], base_idx])*sympy.Symbol(base_curr)
+    if base_changed or any(curr in changed_currs for curr in comm_currs):
+        base_table = sympy.Matrix([[float(matrix[base_idx, index[curr]])*sympy.Symbol(curr) for curr in comm_currs]])
+        rates_vars[base_curr] = rates_vars[base_curr.lower()] = base_table
+    calcpy.push(rates_vars, interactive=False)
+    calcpy._pushed_currency = (base_curr, comm_currs, rates)
+    # name: value as pushed, a name the user rebound is no longer a currency
+    calcpy._currency_vars = {**getattr(calcpy, '_currency_vars', {}), **rates_vars}
+
+def push_cached_rates(calcpy):
+    cached = get_cached_rates(calcpy)
+    if cached is None:
+        return False
+    try:
+        push_rates(calcpy, cached['rates'], full=True)
     except Exception as e:
-        if IPython.get_ipython().calcpy.debug:
-            print(f'Crypto currency fetch failed: {e}')
-    return rates
+        if calcpy.debug:
+            print(f'Cannot load cached currency rates: {e}')
+        return False
+    return True
 
 def update_currency(calcpy):
     try:
-        base_curr = calcpy.base_currency
-        comm_currs = list(filter(base_curr.__ne__, calcpy.common_currencies))
-        rates = get_rates()
+        rates_time, rates = get_rates()
+        cached = get_cached_rates(calcpy)
+        if cached is not None:
+            if rates_time == cached['time']:
+                # same ECB publication (e.g. weekends), only crypto currencies might have changed
+                rates = {curr: rate for curr, rate in rates.items() if curr in CRYPTO_CURRENCIES}
+            # keep last known rates of currencies that failed to fetch
+            rates = {**cached['rates'], **rates}
+        set_cached_rates(calcpy, rates_time, rates)
+        # pushes only rates that changed since last push
+        push_rates(calcpy, rates)
     except Exception as e:
         if IPython.get_ipython().calcpy.debug:
             print(f"Cannot update currency rates: {e}, retry by 'calcpy.update_currency()")
-        return
+        return False
+    return True
 
-    base_rate = rates[base_curr]
-    rates_vars = {key: (base_rate/value)*sympy.Symbol(base_curr) for key, value in rates.items()}
-    calcpy.push(rates_vars, interactive=False)
-    calcpy.push({k.lower(): v for k, v in rates_vars.items()}, interactive=False)
-    base_table = sympy.Matrix([[(rates[curr]/base_rate)*sympy.Symbol(curr) for curr in comm_currs]])
-    calcpy.push({base_curr: base_table}, interactive=False)
-    calcpy.push({base_curr.lower(): base_table}, interactive=False)
+def update_currency_if_expired(calcpy):
+    '''refresh rates if the cache is older than calcpy.currency_cache_ttl, returns seconds until next check'''
+    ttl = calcpy.currency_cache_ttl*60*60
+    cached = get_cached_rates(calcpy)
+    if cached is not None:
+        age = time() - cached['timestamp']
+        if 0 <= age < ttl:
+            return ttl - age
+    if update_currency(calcpy):
+        return ttl
+    return min(ttl, UPDATE_RETRY_SEC)
+
+class RatesHistory():
+    '''ECB historical rates (per EUR), an array per currency indexed by sorted array of dates'''
+    def __init__(self, path):
+        self.path = path
+        self.dates = np.array([], dtype='datetime64[D]')
+        self.rates = {}
+        self.checked_date = None
+        if os.path.isfile(path):
+            with np.load(path) as data:
+                self.dates = data['dates']
+                self.rates = {curr: data[curr] for curr in data.files if curr != 'dates'}
+
+    def save(self):
+        with open(self.path + '.tmp', 'wb') as f:
+            np.savez(f, dates=self.dates, **self.rates)
+        os.replace(self.path + '.tmp', self.path)
+
+    def last_date(self):
+        return self.dates[-1] if len(self.dates) else None
+
+    def append(self, days):
+        '''append days newer than last stored date, returns number of days appended'''
+        last_date = self.last_date()
+        new_dates = np.array(sorted(days), dtype='datetime64[D]')
+        if last_date is not None:
+            new_dates = new_dates[new_dates > last_date]
+        if len(new_dates) == 0:
+            return 0
+        new_days = [days[str(date)] for date in new_dates]
+        currs = set(self.rates).union(*new_days) - {'EUR'}
+        for curr in currs:
+            old_rates = self.rates.get(curr, np.full(len(self.dates), np.nan))
+            new_rates = np.array([rates.get(curr, np.nan) for rates in new_days])
+            self.rates[curr] = np.concatenate([old_rates, new_rates])
+        self.dates = np.concatenate([self.dates, new_dates])
+        return len(new_dates)
+
+    def rate(self, curr, date):
+        '''rate of curr (per EUR) published at date, or the last publication before it'''
+        if curr == 'EUR':
+            return 1.00
+        date = np.datetime64(date, 'D')
+        idx = np.searchsorted(self.dates, date, side='right') - 1
+        rates = self.rates.get(curr)
+        if rates is None or idx < 0 or np.isnan(rates[idx]):
+            raise ValueError(f'No historical rate for {curr} at {date}')
+        return float(rates[idx])
+
+def update_rates_history(history):
+    session = get_session()
+    if history.last_date() is not None:
+        resp = session.get(ECB_HIST_90D_URL, timeout=FETCH_TIMEOUT_SEC)
+        resp.raise_for_status()
+        days = parse_ecb_xml(resp.content)
+        # no gap between stored history and last 90 days, append without full download
+        if np.datetime64(min(days), 'D') <= history.last_date():
+            return history.append(days)
+    resp = session.get(ECB_HIST_URL, timeout=FETCH_TIMEOUT_SEC)
+    resp.raise_for_status()
+    return history.append(parse_ecb_csv_zip(resp.content))
+
+def get_rates_history(calcpy, date=None):
+    history = getattr(calcpy, '_rates_history', None)
+    if history is None:
+        history = calcpy._rates_history = RatesHistory(os.path.join(calcpy.shell.profile_dir.location, HISTORY_FILE_NAME))
+    today = datetime.date.today()
+    last_date = history.last_date()
+    # fetch at most once a day, only when asked date is not stored yet
+    if history.checked_date != today and (last_date is None or date is None or np.datetime64(date, 'D') > last_date):
+        history.checked_date = today
+        try:
+            if update_rates_history(history):
+                history.save()
+        except Exception as e:
+            if calcpy.debug:
+                print(f'Cannot update historical currency rates: {e}')
+    return history
+
+def currency_at(curr, date):
+    '''Value of curr in base currency by ECB rates at date, e.g. 10USD @ d"2020-01-01" is 10*currency_at('USD', d"2020-01-01")'''
+    calcpy = IPython.get_ipython().calcpy
+    if isinstance(date, str):
+        date = datetime.date.fromisoformat(date)
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    if not isinstance(date, datetime.date):
+        raise TypeError(f'Expected date, got {type(date)}')
+    curr = curr.upper()
+    check_currency(curr)
+    history = get_rates_history(calcpy, date)
+    base_curr = calcpy.base_currency
+    base_rate = history.rate(base_curr, date)
+    if curr == base_curr:
+        comm_currs = list(filter(base_curr.__ne__, calcpy.common_currencies))
+        return sympy.Matrix([[(history.rate(comm_curr, date)/base_rate)*sympy.Symbol(comm_curr) for comm_curr in comm_currs]])
+    return (base_rate/history.rate(curr, date))*sympy.Symbol(base_curr)
 
 def update_currency_job(ip):
     while True:
-        update_currency(ip.calcpy)
-        sleep(60*60*12) # 12 hours
+        sleep(max(update_currency_if_expired(ip.calcpy), 1))
 
 def init(ip:IPython.InteractiveShell):
     type(ip.calcpy).base_currency = property(get_base_currency, set_base_currency)
     type(ip.calcpy).common_currencies = property(get_common_currencies, set_common_currencies)
     type(ip.calcpy).update_currency = update_currency
+    type(ip.calcpy).convert = convert
 
+    # cached rates are available immediately, network refresh happens in the background
+    push_cached_rates(ip.calcpy)
     ip.calcpy.jobs.new(update_currency_job, ip, daemon=True)
-
-
-
@@ -1,3 +1,6 @@
+import pytest
+import os
+import threading
 from sympy.abc import x
 
 def test_store_restore_var(ip):
@@ -38,3 +41,281 @@ def test_store_autovars(ip):
     ip.run_cell('calcpy.auto_store = True')
     assert ip.run_cell('x').result == x
 
+
+def test_store_changed_only(ip, monkeypatch):
+    writes = []
+    db_write = ip.autostore.db.write
+    def write(changed={}, deleted=[], replace=True):
+        if changed or deleted:
+            writes.append((set(changed), set(deleted)))
+        db_write(changed, deleted, replace)
+    monkeypatch.setattr(ip.autostore.db, 'write', write)
+    ip.run_cell('test_list = [1, 2]')
+    ip.run_cell('test_int = 5')
+    assert [changed for changed, deleted in writes] == [{'test_list'}, {'test_int'}]
+    ip.run_cell('1 + 1')
+    assert len(writes) == 2
+    ip.run_cell('test_list.append(3); del test_int') # in place change and deletion in one batch
+    assert len(writes) == 3
+    assert writes[-1][0] == {'test_list'} and 'test_int' in writes[-1][1]
+    assert 'test_int' not in ip.autostore.db.keys()
+    ip.run_cell('calcpy.auto_store = False')
+    ip.run_cell('calcpy.auto_store = True')
+    assert ip.run_cell('test_list').result == [1, 2, 3]
+    assert 'test_int' not in ip.user_ns
+
+def test_store_touched_only(ip, monkeypatch):
+    import pickle
+    from previewer import CellPickles
+    ip.run_cell('test_list = [1, 2]; test_alias = test_list')
+    ip.run_cell('def test_func():\n  test_list.append(3)')
+    dumped = []
+    dumps = CellPickles.dumps
+    monkeypatch.setattr(CellPickles, 'dumps', lambda self, val: dumped.append(val) or dumps(self, val))
+    ip.run_cell('1 + 1')
+    assert dumped == [] # not pickled again unless the cell may have changed it
+    ip.run_cell('test_func()') # through a function's globals
+    assert ip.autostore.stored['test_list'][1] == ip.autostore.stored['test_alias'][1]
+    assert pickle.loads(ip.autostore.db.pickled('test_alias')) == [1, 2, 3]
+    ip.run_cell('get_ipython().user_ns["test_list"].append(4)') # can't tell, everything is checked
+    assert pickle.loads(ip.autostore.db.pickled('test_list')) == [1, 2, 3, 4]
+    ip.run_cell('del test_list, test_alias, test_func')
+
+def test_migrate_pickleshare(ip):
+    ip.run_cell('calcpy.auto_store = False')
+    ip.db['autostore/test_old_var'] = 300
+    ip.db['autostore/_func_test_old_func'] = 'def test_old_func():\n  return 200\n'
+    (ip.db.root / 'autostore' / 'test_old_broken').write_bytes(b'not a pickle')
+    from calcpy.autostore import AutostoreDB, DB_FILE_NAME
+    db = AutostoreDB(os.path.join(ip.profile_dir.location, DB_FILE_NAME))
+    db.user_version(0)
+    db.close()
+    ip.run_cell('calcpy.auto_store = True')
+    assert ip.run_cell('test_old_var').result == 300
+    assert ip.run_cell('test_old_func()').result == 200
+    assert ip.db.keys('autostore/*') == ['autostore/test_old_broken'] # not unpickled, not migrated and not deleted
+    assert (ip.db.root / 'autostore' / 'test_old_broken').read_bytes() == b'not a pickle'
+    assert set(ip.autostore._get_stored()) >= {'test_old_var', 'test_old_func'}
+    assert 'test_old_broken' not in ip.autostore._get_stored()
+    del ip.db['autostore/test_old_broken']
+
+def test_lazy_restore(ip):
+    from calcpy.autostore import LazyVar
+    ip.run_cell('test_list = [1, 2]')
+    ip.run_cell('test_unused = 3')
+    ip.run_cell('def test_func():\n  return test_list[0]')
+    ip.run_cell('calcpy.auto_store = False')
+    ip.run_cell('del test_list, test_unused, test_func')
+    ip.run_cell('calcpy.auto_store = True')
+    assert isinstance(ip.user_ns['test_unused'], LazyVar)
+    assert 'test_unused' in ip.run_line_magic('who_ls', '')
+    assert ip.run_cell('test_func()').result == 1 # referenced by restored function
+    assert ip.user_ns['test_list'] == [1, 2]
+    assert ip.run_cell('2test_unused').result == 6
+    assert ip.user_ns['test_unused'] == 3
+    ip.run_cell('test_list.append(3)')
+    ip.run_cell('calcpy.auto_store = False')
+    ip.run_cell('calcpy.auto_store = True')
+    assert ip.run_cell('test_list').result == [1, 2, 3]
+
+def test_lazy_latex_and_probes(ip):
+    from calcpy.autostore import LazyVar
+    ip.run_cell('y = 2')
+    ip.run_cell('calcpy.auto_store = False')
+    ip.run_cell('del y')
+    ip.run_cell('calcpy.auto_store = True')
+    lazy_var = ip.user_ns['y']
+    assert isinstance(lazy_var, LazyVar)
+    assert not hasattr(lazy_var, '__float__')
+    assert ip.transform_cell('3y').strip() == '3*y'
+    assert ip.user_ns['y'] is lazy_var # probes didn't load it
+    assert ip.run_cell('$y+1$').result == 3 # not seen by the lazy loader
+    ip.run_cell('del y')
+
+def test_lazy_del_no_restore(ip):
+    ip.run_cell('test_var = 100')
+    ip.run_cell('calcpy.auto_store = False')
+    ip.run_cell('del test_var')
+    ip.run_cell('calcpy.auto_store = True')
+    ip.run_cell('del test_var') # never loaded
+    ip.run_cell('calcpy.auto_store = False')
+    ip.run_cell('calcpy.auto_store = True')
+    assert 'test_var' not in ip.user_ns
+
+def test_restore_func_cached(ip, monkeypatch):
+    import inspect
+    from calcpy import autostore
+    ip.run_cell('def test_func():\n  return 100')
+    ip.run_cell('def test_func2():\n  return test_func() + 1')
+    ip.run_cell('calcpy.auto_store = False')
+    ip.run_cell('calcpy.auto_store = True') # compiles and caches
+    file_path = inspect.getsourcefile(ip.user_ns['test_func'])
+    assert file_path.startswith(ip.profile_dir.location)
+    mtime = os.path.getmtime(file_path)
+
+    compiled = []
+    monkeypatch.setattr(autostore, 'compile', lambda *args, **kwargs: compiled.append(args), raising=False)
+    ip.run_cell('calcpy.auto_store = False')
+    ip.run_cell('del test_func, test_func2')
+    ip.run_cell('calcpy.auto_store = True')
+    assert compiled == []
+    assert ip.run_cell('test_func2()').result == 101
+    assert os.path.getmtime(file_path) == mtime # file not rewritten
+    assert inspect.getsource(ip.user_ns['test_func']) == 'def test_func():\n  return 100\n'
+
+def test_write_behind(ip, monkeypatch):
+    from calcpy.autostore import WriteBehind
+    ip.run_cell('calcpy.auto_store_write_behind = True')
+    assert isinstance(ip.autostore.writer, WriteBehind)
+    writes = []
+    db_write = ip.autostore.db.write
+    write_event = threading.Event()
+    def write(changed={}, deleted=[], replace=True):
+        write_event.wait() # slow storage
+        writes.append((dict(changed), set(deleted)))
+        db_write(changed, deleted, replace)
+    monkeypatch.setattr(ip.autostore.db, 'write', write)
+    monkeypatch.setattr(ip.autostore.writer, 'delay', 0.1)
+
+    ip.run_cell('test_var = 1')
+    ip.run_cell('test_var = 2')
+    ip.run_cell('test_list = [1]; test_list.append(2)')
+    assert writes == [] # prompt doesn't wait for storage
+    write_event.set()
+    ip.autostore.writer.flush()
+    assert len(writes) <= 2
+    assert ip.autostore.db['test_var'] == 2 and ip.autostore.db['test_list'] == [1, 2]
+    assert writes[-1][0].keys() >= {'test_list'} # coalesced
+
+    monkeypatch.setattr(ip.autostore.writer, 'max_bytes', 10)
+    ip.run_cell('test_big = list(range(100))') # over limit, written synchronously
+    assert ip.autostore.db['test_big'] == list(range(100))
+    ip.run_cell('del test_big')
+    ip.run_cell('calcpy.auto_store_write_behind = False') # flushes
+    assert 'test_big' not in ip.autostore.db.keys()
+
+def test_write_behind_retry(ip, monkeypatch):
+    import sqlite3
+    ip.run_cell('calcpy.auto_store_write_behind = True')
+    db_write = ip.autostore.db.write
+    failures = [sqlite3.OperationalError('database is locked')]
+    def write(changed={}, deleted=[], replace=True):
+        if failures:
+            raise failures.pop()
+        db_write(changed, deleted, replace)
+    monkeypatch.setattr(ip.autostore.db, 'write', write)
+    monkeypatch.setattr(ip.autostore.writer, 'delay', 10)
+    ip.run_cell('test_var = 1; test_other = 1')
+    with pytest.raises(sqlite3.OperationalError):
+        ip.autostore.writer.flush()
+    ip.run_cell('test_var = 2') # newer than the failed batch
+    ip.autostore.writer.flush()
+    assert ip.autostore.db['test_var'] == 2 and ip.autostore.db['test_other'] == 1
+    ip.run_cell('del test_var, test_other')
+    ip.run_cell('calcpy.auto_store_write_behind = False')
+
+def test_store_large_array(ip, monkeypatch):
+    import numpy as np
+    from calcpy.autostore import NPY_MIN_BYTES
+    ip.run_cell('import numpy as np')
+    ip.run_cell(f'test_arr = np.arange({NPY_MIN_BYTES // 8}, dtype=np.float64)')
+    npy_path = ip.autostore.npy_path('test_arr')
+    assert os.path.isfile(npy_path)
+    assert len(ip.autostore.db.items('test_arr')[0][1]) < 1000
+    ip.run_cell('calcpy.auto_store = False')
+    ip.run_cell('del test_arr')
+    ip.run_cell('calcpy.auto_store = True')
+    ip.run_cell('test_arr[0] = 5')
+    assert isinstance(ip.user_ns['test_arr'], np.memmap)
+
+    writes = []
+    monkeypatch.setattr(ip.autostore.db, 'write', lambda changed={}, deleted=[]: writes.append(set(changed)))
+    ip.run_cell('test_arr[1] = 6') # in place change, written through the mapping
+    assert 'test_arr' not in set().union(*writes)
+    monkeypatch.undo()
+    ip.run_cell('calcpy.auto_store = False')
+    ip.run_cell('del test_arr')
+    ip.run_cell('calcpy.auto_store = True')
+    assert ip.run_cell('test_arr[:3]').result.tolist() == [5, 6, 2]
+
+    ip.run_cell('test_arr = test_arr * 2') # new array replaces the file
+    ip.run_cell('calcpy.auto_store = False')
+    ip.run_cell('del test_arr')
+    ip.run_cell('calcpy.auto_store = True')
+    assert ip.run_cell('test_arr[:3]').result.tolist() == [10, 12, 4]
+    ip.run_cell('del test_arr')
+    assert not os.path.isfile(npy_path)
+
+def test_store_large_array_write_behind(ip, monkeypatch):
+    from calcpy.autostore import NPY_MIN_BYTES
+    ip.run_cell('import numpy as np')
+    ip.run_cell('calcpy.auto_store_write_behind = True')
+    monkeypatch.setattr(ip.autostore.writer, 'delay', 10)
+    npy_path = ip.autostore.npy_path('test_arr')
+    file_on_write = []
+    db_write = ip.autostore.db.write
+    def write(changed={}, deleted=[], replace=True):
+        file_on_write.append(os.path.isfile(npy_path))
+        db_write(changed, deleted, replace)
+    monkeypatch.setattr(ip.autostore.db, 'write', write)
+    ip.run_cell(f'test_arr = np.arange({NPY_MIN_BYTES // 8}, dtype=np.float64)')
+    assert not os.path.isfile(npy_path) # written with its row
+    ip.user_ns['test_arr'][0] = -1 # in place change after the cell, not written with it
+    ip.autostore.writer.flush()
+    assert file_on_write == [True] and os.path.isfile(npy_path)
+    import numpy as np
+    assert np.load(npy_path)[0] == 0
+    ip.run_cell('test_arr = 1')
+    ip.autostore.writer.flush()
+    assert file_on_write == [True, True] # removed once the row no longer refers to it
+    assert not os.path.isfile(npy_path) and ip.autostore.db['test_arr'] == 1
+    ip.run_cell('del test_arr')
+    ip.run_cell('calcpy.auto_store_write_behind = False')
+
+def test_store_quota(ip, monkeypatch, capsys):
+    monkeypatch.setattr(ip.calcpy, 'auto_store_var_quota_mb', 0.1)
+    ip.run_cell('import os')
+    ip.run_cell('test_big = list(os.urandom(200000))') # incompressible
+    assert 'not stored' in capsys.readouterr().out
+    assert 'test_big' not in ip.autostore.db.keys()
+    ip.run_cell('1 + 1')
+    assert 'not stored' not in capsys.readouterr().out # warned once
+    ip.run_cell('test_big = test_big[:10]') # fits now
+    assert ip.autostore.db['test_big'] == ip.user_ns['test_big']
+
+    monkeypatch.setattr(ip.calcpy, 'auto_store_quota_mb', sum(ip.autostore.sizes.values()) / 2**20)
+    ip.run_cell('test_var = 1')
+    assert 'test_var' not in ip.autostore.db.keys()
+    assert 'not stored' in capsys.readouterr().out
+
+def test_store_compress(ip, capsys):
+    from calcpy.autostore import COMPRESS_MIN_BYTES, ZSTD_MAGIC, XZ_MAGIC
+    ip.run_cell(f'test_str = "calcpy" * {COMPRESS_MIN_BYTES}')
+    pickled = ip.autostore.db.items('test_str')[0][1]
+    assert pickled[:4] == ZSTD_MAGIC or pickled[:6] == XZ_MAGIC
+    assert len(pickled) < COMPRESS_MIN_BYTES
+    ip.run_cell('calcpy.auto_store = False')
+    ip.run_cell('del test_str')
+    ip.run_cell('calcpy.auto_store = True')
+    ip.run_cell('test_str[:6]')
+    capsys.readouterr()
+    ip.calcpy.autostore_stats()
+    test_str_row = [line for line in capsys.readouterr().out.splitlines() if line.startswith('test_str ')][0]
+    assert 'ms' in test_str_row
+    assert ip.run_cell('len(test_str)').result == 6 * COMPRESS_MIN_BYTES
+
+
+def test_restore_without_zstandard(ip, monkeypatch, capsys):
+    from calcpy import autostore
+    from calcpy.autostore import ZSTD_MAGIC
+    ip.autostore.db.write({'test_zstd': ZSTD_MAGIC + b'data'})
+    ip.run_cell('calcpy.auto_store = False')
+    monkeypatch.setattr(autostore, 'zstandard', None)
+    ip.run_cell('calcpy.auto_store = True')
+    capsys.readouterr()
+    ip.run_cell('test_zstd')
+    assert 'not restored' in capsys.readouterr().out
+    assert 'test_zstd' not in ip.user_ns
+    assert 'test_zstd' in ip.autostore.db.keys() # kept for a session that has zstandard
+    ip.autostore.db.write(deleted=['test_zstd'])
+
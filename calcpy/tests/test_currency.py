@@ -1,7 +1,257 @@
+import os
+import io
+import zipfile
+import threading
+from time import time, sleep, perf_counter
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+import numpy as np
+import sympy
+from calcpy import currency
+
+ECB_DAILY_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<gesmes:Envelope xmlns:gesmes="http://www.gesmes.org/xml/2002-08-01" xmlns="http://www.ecb.int/vocabulary/2002-08-01/eurofxref">
+<Cube>
+<Cube time="{time}">
+<Cube currency="USD" rate="{usd}"/>
+<Cube currency="JPY" rate="160"/>
+<Cube currency="GBP" rate="0.8"/>
+<Cube currency="ILS" rate="4"/>
+<Cube currency="CNY" rate="8"/>
+</Cube>
+</Cube>
+</gesmes:Envelope>'''
+
+ECB_HIST_90D_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<gesmes:Envelope xmlns:gesmes="http://www.gesmes.org/xml/2002-08-01" xmlns="http://www.ecb.int/vocabulary/2002-08-01/eurofxref">
+<Cube>
+<Cube time="2020-01-06">
+<Cube currency="USD" rate="1.1194"/>
+<Cube currency="ILS" rate="3.8771"/>
+</Cube>
+<Cube time="2020-01-03">
+<Cube currency="USD" rate="1.1147"/>
+<Cube currency="ILS" rate="3.8640"/>
+</Cube>
+</Cube>
+</gesmes:Envelope>'''
+
+HIST_FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'eurofxref-hist.csv')
+
+class StubRatesServer(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubRatesHandler)
+        self.requests = []
+        self.time = '2024-01-05'
+        self.usd = 1.25
+        self.delay = 0
+        self.failing_symbols = []
+        self.country = 'IL'
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def handle_error(self, request, client_address):
+        pass # client gave up (timeout)
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.server_address[1]}/{path}'
+
+class StubRatesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        url = urlparse(self.path)
+        sleep(self.server.delay)
+        if url.path == '/eurofxref-daily.xml':
+            body = ECB_DAILY_XML.format(time=self.server.time, usd=self.server.usd).encode()
+        elif url.path == '/ticker/price' and \
+          parse_qs(url.query)['symbol'][0] not in self.server.failing_symbols:
+            body = b'{"price": "40000"}'
+        elif url.path == '/eurofxref-hist.zip':
+            zip_bytes = io.BytesIO()
+            with zipfile.ZipFile(zip_bytes, 'w') as zip_file:
+                zip_file.write(HIST_FIXTURE_PATH, 'eurofxref-hist.csv')
+            body = zip_bytes.getvalue()
+        elif url.path == '/eurofxref-hist-90d.xml':
+            body = ECB_HIST_90D_XML.encode()
+        elif url.path == '/json':
+            body = f'{{"country": "{self.server.country}"}}'.encode()
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def rates_server(ip, monkeypatch):
+    server = StubRatesServer()
+    monkeypatch.setattr(currency, 'ECB_DAILY_URL', server.url('eurofxref-daily.xml'))
+    monkeypatch.setattr(currency, 'BINANCE_PRICE_URL', server.url('ticker/price'))
+    monkeypatch.setattr(currency, 'IPINFO_URL', server.url('json'))
+    monkeypatch.setattr(currency, 'ECB_HIST_URL', server.url('eurofxref-hist.zip'))
+    monkeypatch.setattr(currency, 'ECB_HIST_90D_URL', server.url('eurofxref-hist-90d.xml'))
+    ip.calcpy.shell.db[currency.BASE_CURRENCY_VAR_PATH] = 'EUR'
+    ip.calcpy.shell.db.pop(currency.RATES_VAR_PATH, None)
+    yield server
+    server.shutdown()
+    server.server_close()
+
 def test_currency(ip):
     ip.run_cell('calcpy.update_currency()')
     res = ip.run_cell('10gbp').result
     base_cur = ip.run_cell('calcpy.base_currency').result
     assert str(res.args[1]) == base_cur
 
+def test_currency_cached_offline(ip, rates_server):
+    currency.update_currency(ip.calcpy)
+    rates_server.shutdown() # no network from now on
+    ip.run_cell('del USD, usd')
+    assert 'USD' not in ip.user_ns
+    assert currency.push_cached_rates(ip.calcpy)
+    assert ip.run_cell('10USD').result == ip.run_cell('32ILS').result
+    assert ip.run_cell('1btc').result == ip.run_cell('160000ils').result
+
+def test_currency_cache_ttl(ip, rates_server):
+    assert currency.update_currency_if_expired(ip.calcpy) == ip.calcpy.currency_cache_ttl*60*60
+    assert currency.get_cached_rates(ip.calcpy)['time'] == '2024-01-05'
+    n_requests = len(rates_server.requests)
+
+    rates_server.time, rates_server.usd = '2024-01-08', 1.5
+    assert currency.update_currency_if_expired(ip.calcpy) > 0
+    assert len(rates_server.requests) == n_requests # cache is fresh
+    assert ip.run_cell('10USD').result == ip.run_cell('32ILS').result
+
+    cached = currency.get_cached_rates(ip.calcpy)
+    cached['timestamp'] = time() - ip.calcpy.currency_cache_ttl*60*60 - 1
+    ip.calcpy.shell.db[currency.RATES_VAR_PATH] = cached
+    currency.update_currency_if_expired(ip.calcpy)
+    assert len(rates_server.requests) > n_requests
+    assert currency.get_cached_rates(ip.calcpy)['time'] == '2024-01-08'
+    assert ip.run_cell('15USD').result == ip.run_cell('40ILS').result
+
+def test_currency_concurrent_fetch(ip, rates_server):
+    rates_server.delay = 0.2
+    t = perf_counter()
+    rates_time, rates = currency.get_rates()
+    # ecb and all crypto currencies requested concurrently
+    assert perf_counter() - t < rates_server.delay * (len(currency.CRYPTO_CURRENCIES) + 1) / 2
+    assert set(currency.CRYPTO_CURRENCIES) <= set(rates)
+
+def test_currency_partial_fetch(ip, rates_server, monkeypatch):
+    currency.update_currency(ip.calcpy)
+    rates_server.failing_symbols = ['BTCEUR']
+    rates_time, rates = currency.get_rates()
+    assert 'BTC' not in rates and 'ETH' in rates and 'USD' in rates
+
+    # cached rate is kept for the failed currency
+    rates_server.time, rates_server.usd = '2024-01-08', 1.5
+    assert currency.update_currency(ip.calcpy)
+    assert currency.get_cached_rates(ip.calcpy)['rates']['BTC'] == 1/40000
+    assert ip.run_cell('15USD').result == ip.run_cell('40ILS').result
+
+    # slow responses are dropped after timeout
+    monkeypatch.setattr(currency, 'FETCH_TIMEOUT_SEC', 0.1)
+    rates_server.delay = 0.5
+    t = perf_counter()
+    assert not currency.update_currency(ip.calcpy)
+    assert perf_counter() - t < rates_server.delay
+
+def test_base_currency_lookup(ip, rates_server, monkeypatch):
+    currency.update_currency(ip.calcpy)
+    monkeypatch.setenv('LANG', 'de_DE.UTF-8')
+    monkeypatch.delenv('LC_ALL', raising=False)
+    monkeypatch.delenv('LC_MONETARY', raising=False)
+    monkeypatch.setattr(ip.calcpy, '_base_currency_lookup_job', None, raising=False)
+    del ip.calcpy.shell.db[currency.BASE_CURRENCY_VAR_PATH]
+    rates_server.delay = 0.5
+
+    t = perf_counter()
+    assert ip.calcpy.base_currency == 'EUR' # locale guess, not stored
+    assert perf_counter() - t < rates_server.delay
+    assert currency.BASE_CURRENCY_VAR_PATH not in ip.calcpy.shell.db
+
+    ip.calcpy._base_currency_lookup_job.join()
+    assert ip.calcpy.base_currency == 'ILS'
+    assert ip.calcpy.shell.db[currency.BASE_CURRENCY_VAR_PATH] == 'ILS'
+    assert ip.run_cell('8GBP').result == ip.run_cell('10EUR').result
+
+def test_guess_base_currency(monkeypatch):
+    monkeypatch.setenv('LC_ALL', 'en_GB.UTF-8')
+    assert currency.guess_base_currency() == 'GBP'
+    monkeypatch.setenv('LC_ALL', 'he_IL')
+    assert currency.guess_base_currency() == 'ILS'
+    monkeypatch.setenv('LC_ALL', 'C')
+    monkeypatch.setenv('LC_MONETARY', 'ja_JP.eucJP')
+    assert currency.guess_base_currency() == 'JPY'
+
+def test_convert(ip, rates_server):
+    currency.update_currency(ip.calcpy)
+    assert ip.calcpy.convert(10, 'USD', 'ILS') == 32
+    assert ip.calcpy.convert(8, 'gbp') == 10 # to base currency
+    prices = np.array([[1.25, 2.5], [12.5, 0]])
+    assert np.array_equal(ip.calcpy.convert(prices, 'USD', 'EUR'), [[1, 2], [10, 0]])
+    assert ip.run_cell('calcpy.convert(10, "USD", "ILS")').result == 32
+    with pytest.raises(ValueError):
+        ip.calcpy.convert(1, 'USD', 'XYZ')
+
+def test_currency_push_changed_only(ip, rates_server, monkeypatch):
+    currency.update_currency(ip.calcpy)
+    pushes = []
+    calcpy_push = ip.calcpy.push
+    monkeypatch.setattr(ip.calcpy, 'push', lambda variables, interactive=True:
+                        pushes.append(variables) or calcpy_push(variables, interactive))
+
+    currency.update_currency(ip.calcpy) # same ECB time and rates
+    assert pushes == []
+
+    rates_server.time, rates_server.usd = '2024-01-08', 1.5
+    currency.update_currency(ip.calcpy)
+    assert len(pushes) == 1
+    assert set(pushes[0]) == {'USD', 'usd', 'EUR', 'eur'} # base table includes USD
+    assert ip.run_cell('15USD').result == ip.run_cell('40ILS').result
+
+def test_rates_history(ip, rates_server, monkeypatch, tmp_path):
+    history_path = str(tmp_path / currency.HISTORY_FILE_NAME)
+    monkeypatch.setattr(ip.calcpy, '_rates_history', currency.RatesHistory(history_path), raising=False)
+    currency.update_currency(ip.calcpy)
+    eur = sympy.Symbol('EUR')
+
+    # new year's day, last publication before it is used:
+    assert ip.run_cell('10USD @ d"2020-01-01"').result == 10/1.1234*eur
+    assert ip.run_cell('(10USD + 3ils) @ d"2020-01-02"').result == (10/1.1193 + 3/3.8717)*eur
+    assert rates_server.requests.count('/eurofxref-hist.zip') == 1
+    assert ip.run_cell('10USD').result == 8.0*eur # latest rates unchanged
+    assert ip.run_cell('10USD @ "2020-01-01"').result == 10/1.1234*eur
+
+    history = currency.RatesHistory(history_path) # reload from disk
+    assert len(history.dates) == 5
+    assert history.rate('CYP', '2010-01-01') == 0.585274
+    assert history.rate('GBP', '2019-12-30') == 0.85520
+    with pytest.raises(ValueError):
+        history.rate('USD', '2000-01-01')
+    with pytest.raises(ValueError):
+        history.rate('CYP', '2020-01-01') # N/A since 2008
+
+    # only last 90 days are fetched and appended:
+    ip.calcpy._rates_history.checked_date = None
+    assert currency.currency_at('USD', '2020-01-07') == 1/1.1194*eur
+    assert rates_server.requests.count('/eurofxref-hist.zip') == 1
+    assert rates_server.requests.count('/eurofxref-hist-90d.xml') == 1
+    assert len(currency.RatesHistory(history_path).dates) == 6
+
+def test_currency_names_matmul(ip, rates_server):
+    currency.update_currency(ip.calcpy)
+    # rebound currency names are multiplied as usual
+    ip.run_cell('sol = Matrix([[1, 2], [3, 4]])')
+    assert ip.run_cell('sol @ sol').result == sympy.Matrix([[7, 10], [15, 22]])
+    ip.run_cell('eth = np.eye(2)')
+    assert np.array_equal(ip.run_cell('eth @ np.ones(2)').result, [1, 1])
+    ip.run_cell('del sol, eth')
+    currency.push_rates(ip.calcpy, currency.get_cached_rates(ip.calcpy)['rates'], full=True)
 
@@ -0,0 +1,367 @@
+import pytest
+from time import sleep, perf_counter
+from types import SimpleNamespace
+from prompt_toolkit.buffer import Buffer
+from prompt_toolkit.styles import Style
+
+PREVIEW_TIMEOUT_SEC = 30
+
+@pytest.fixture(scope='module')
+def previewer_ip(session_ip):
+    ip = session_ip
+    ip.pt_app = SimpleNamespace(style=Style([]), default_buffer=Buffer(), bottom_toolbar=None,
+                                app=SimpleNamespace(invalidate=lambda: None, style=Style([])))
+    ip.calcpy.load_previewer()
+    yield ip
+    ip.calcpy.unload_previewer()
+    del ip.pt_app
+
+def preview(ip, text, expected):
+    ip.pt_app.default_buffer.text = ''
+    ip.pt_app.default_buffer.text = text
+    t = perf_counter()
+    while ip.pt_app.bottom_toolbar != expected and perf_counter() - t < PREVIEW_TIMEOUT_SEC:
+        sleep(0.01)
+    return ip.pt_app.bottom_toolbar
+
+def test_preview(previewer_ip):
+    assert preview(previewer_ip, '2+3', '5') == '5'
+
+def test_preview_sigint_ignored(previewer_ip):
+    import os, signal
+    ip = previewer_ip
+    assert preview(ip, 'abs(-5)', '5') == '5'
+    ip.run_cell('test_sig = 1')
+    standby = ip.previewer.standby # never got a request
+    if not os.path.isfile(f'/proc/{standby.ip_proc.pid}/status'):
+        pytest.skip('no /proc')
+    def sigint_ignored():
+        with open(f'/proc/{standby.ip_proc.pid}/status') as f:
+            sig_ign = int([line for line in f if line.startswith('SigIgn:')][0].split()[1], 16)
+        return sig_ign & (1 << (signal.SIGINT - 1)) != 0
+    t = perf_counter()
+    while not sigint_ignored() and perf_counter() - t < 10:
+        sleep(0.05)
+    assert sigint_ignored() # terminal's ctrl+c doesn't kill it
+    ip.run_cell('del test_sig')
+
+def test_preview_sync(previewer_ip):
+    ip = previewer_ip
+    ip.run_cell('test_a = 41')
+    assert preview(ip, 'test_a + 1', '42') == '42'
+    ip.run_cell('test_a = 1')
+    assert preview(ip, 'test_a + 1', '2') == '2'
+    ip.run_cell('del test_a')
+    assert preview(ip, '"test_a" in globals()', 'False') == 'False'
+
+def test_preview_sync_delta(previewer_ip, monkeypatch):
+    from previewer import NsDelta
+    ip = previewer_ip
+    sent = []
+    ns_conn_send = ip.previewer.ns_conn.send
+    monkeypatch.setattr(ip.previewer.ns_conn, 'send', lambda msg: sent.append(msg) or ns_conn_send(msg))
+    ip.run_cell('test_b = 2')
+    ip.run_cell('del test_b')
+    deltas = [msg for msg in sent if isinstance(msg, NsDelta)]
+    assert len(deltas) == 2
+    assert 'test_b' in deltas[0].pickled_vars and 'pi' not in deltas[0].pickled_vars
+    assert len(deltas[0].pickled_vars) < 10
+    assert deltas[1].deleted == ['test_b']
+
+def test_preview_history(previewer_ip, monkeypatch):
+    from previewer import NsDelta, HistoryEntry
+    ip = previewer_ip
+    sent = []
+    ns_conn_send = ip.previewer.ns_conn.send
+    monkeypatch.setattr(ip.previewer.ns_conn, 'send', lambda msg: sent.append(msg) or ns_conn_send(msg))
+    count = ip.execution_count
+    ip.run_cell('[41]', store_history=True)
+    ip.run_cell('[42]', store_history=True)
+    deltas = [msg for msg in sent if isinstance(msg, NsDelta)]
+    assert not any(name.startswith('_') for delta in deltas for name in delta.pickled_vars)
+    assert [msg.result for msg in sent if isinstance(msg, HistoryEntry)] == [[41], [42]] # each result sent once
+    assert preview(ip, f'abs(_[0] - __[0] + _{count}[0] + Out[{count + 1}][0])', '84') == '84'
+    assert preview(ip, f'_i{count}', "'[41]'") == "'[41]'"
+
+def test_preview_baseline(previewer_ip, monkeypatch):
+    from previewer import NsDelta
+    ip = previewer_ip
+    assert preview(ip, 'np.arange(3).sum() + choose(4, 2)', '9') == '9' # previewer's own import of calcpy.user
+    sent = []
+    ns_conn_send = ip.previewer.ns_conn.send
+    monkeypatch.setattr(ip.previewer.ns_conn, 'send', lambda msg: sent.append(msg) or ns_conn_send(msg))
+    ip.run_cell('from calcpy.user import *')
+    assert not any('pi' in msg.pickled_vars for msg in sent if isinstance(msg, NsDelta))
+    ip.run_cell('choose = 5') # rebound
+    assert preview(ip, 'choose + 1', '6') == '6'
+    ip.run_cell('del choose')
+    ip.run_cell('from calcpy.user import *')
+    assert preview(ip, 'choose(4, 2)', '6') == '6'
+
+def test_preview_no_reexecution(previewer_ip):
+    ip = previewer_ip
+    ip.run_cell('test_list = [1]')
+    ip.run_cell('test_list.append(2)') # in place change
+    assert preview(ip, 'len(test_list)', '2') == '2'
+    ip.run_cell('def test_func(x):\n  return x + len(test_list)')
+    assert preview(ip, 'test_func(1)', '3') == '3'
+    ip.run_cell('test_gen = (i for i in range(3)); test_c = 5') # generator can't be pickled, cell runs again
+    assert preview(ip, 'test_c + next(test_gen)', '5') == '5'
+    ip.run_cell('del test_list, test_func, test_gen, test_c')
+
+def test_preview_cancel(previewer_ip):
+    from previewer import CTRL_C_TIMEOUT
+    ip = previewer_ip
+    ip.run_cell('def test_slow():\n  while True: pass')
+    ip.pt_app.default_buffer.text = 'test_slow()'
+    sleep(0.3)
+    t = perf_counter()
+    assert preview(ip, '1+1', '2') == '2'
+    assert perf_counter() - t < CTRL_C_TIMEOUT / 2 # interrupted, not timed out
+    ip.run_cell('del test_slow')
+
+def test_preview_cancel_swallowed(previewer_ip):
+    ip = previewer_ip
+    ip.run_cell('class test_Swallow():\n'
+                '  def __repr__(self):\n'
+                '    t = __import__("time").perf_counter()\n'
+                '    try:\n'
+                '      while __import__("time").perf_counter() - t < 1.5: pass\n'
+                '    except KeyboardInterrupt:\n'
+                '      pass\n'
+                '    return ""')
+    ip.pt_app.default_buffer.text = 'test_Swallow()'
+    sleep(0.3)
+    assert preview(ip, 'abs(1+1)', '2') == '2' # answered after the interrupted one
+    assert not [text for text, generation in ip.previewer.preview_cache if text == 'test_Swallow()'] # interrupted, not an answer
+    ip.run_cell('del test_Swallow')
+
+def test_preview_cache(previewer_ip, monkeypatch):
+    ip = previewer_ip
+    ip.run_cell('test_c = 2')
+    assert preview(ip, 'abs(test_c * 3)', '6') == '6'
+    sent = []
+    exec_conn_send = ip.previewer.exec_conn.send
+    monkeypatch.setattr(ip.previewer.exec_conn, 'send', lambda msg: sent.append(msg) or exec_conn_send(msg))
+    ip.pt_app.bottom_toolbar = None
+    assert preview(ip, 'abs(test_c * 3)', '6') == '6'
+    assert sent == [] # from cache
+    ip.run_cell('test_c = 3') # new generation
+    assert preview(ip, 'abs(test_c * 3)', '9') == '9'
+    assert len(sent) > 0
+    ip.run_cell('del test_c')
+
+def test_preview_standby(previewer_ip):
+    ip = previewer_ip
+    assert preview(ip, 'abs(1+2)', '3') == '3'
+    ip.run_cell('test_d = 7') # active answered, standby is spawned
+    standby = ip.previewer.standby
+    assert standby is not None
+    ip.run_cell('test_d += 1') # synced to both
+    ip.previewer.restart()
+    assert ip.previewer.active is standby and ip.previewer.standby is None
+    assert preview(ip, 'abs(test_d * 2)', '16') == '16'
+    ip.run_cell('del test_d')
+    assert ip.previewer.standby is not None
+
+def test_preview_standby_idle_sync(previewer_ip):
+    from multiprocessing import shared_memory
+    ip = previewer_ip
+    assert preview(ip, 'abs(2+2)', '4') == '4'
+    ip.run_cell('test_f = 1')
+    assert ip.previewer.standby is not None
+    counter = shared_memory.SharedMemory(create=True, size=1)
+    try:
+        # generator can't be pickled, so the cell is re-executed by both processes, while no preview is requested
+        ip.run_cell('test_gen = (i for i in [])\n'
+                    f'test_shm = __import__("multiprocessing.shared_memory").shared_memory.SharedMemory("{counter.name}")\n'
+                    'test_shm.buf[0] += 1; test_shm.close(); del test_shm')
+        t = perf_counter()
+        while counter.buf[0] < 3 and perf_counter() - t < PREVIEW_TIMEOUT_SEC:
+            sleep(0.05)
+        assert counter.buf[0] == 3
+    finally:
+        counter.close()
+        counter.unlink()
+    ip.run_cell('del test_f, test_gen')
+
+def test_preview_lazy_var(previewer_ip):
+    from calcpy.autostore import LazyVar
+    ip = previewer_ip
+    ip.run_cell('test_lazy = [1, 2]; test_lazy_arr = np.arange(300000)')
+    ip.run_cell('calcpy.auto_store = False')
+    ip.run_cell('del test_lazy, test_lazy_arr')
+    ip.run_cell('calcpy.auto_store = True')
+    assert preview(ip, 'abs(sum(test_lazy))', '3') == '3'
+    assert preview(ip, 'int(test_lazy_arr[-1])', '299999') == '299999'
+    assert isinstance(ip.user_ns['test_lazy'], LazyVar) # not loaded by the shell
+    assert isinstance(ip.user_ns['test_lazy_arr'], LazyVar)
+    ip.run_cell('del test_lazy, test_lazy_arr')
+
+def test_preview_shared_memory(previewer_ip, monkeypatch):
+    from multiprocessing import shared_memory
+    from previewer import NsDelta
+    ip = previewer_ip
+    sent = []
+    ns_conn_send = ip.previewer.ns_conn.send
+    monkeypatch.setattr(ip.previewer.ns_conn, 'send', lambda msg: sent.append(msg) or ns_conn_send(msg))
+    ip.run_cell('test_arr = np.arange(1000000); test_bytes = bytes(2000000)')
+    delta = [msg for msg in sent if isinstance(msg, NsDelta)][0]
+    assert len(delta.pickled_vars['test_arr']) < 1000 # buffer is out of band
+    assert set(delta.shared) == {'test_arr', 'test_bytes'}
+    assert preview(ip, 'int(test_arr[-1]) + test_arr.flags.writeable', '999999') == '999999' # mapped read only
+    assert preview(ip, 'isinstance(test_bytes, bytes) and len(test_bytes)', '2000000') == '2000000'
+    t = perf_counter()
+    while any(proc.shared for proc in ip.previewer.processes()) and perf_counter() - t < PREVIEW_TIMEOUT_SEC:
+        sleep(0.01)
+    for block_name, nbytes in delta.shared['test_arr']:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(block_name) # unlinked once mapped by previewer
+    ip.run_cell('test_arr[0] = 1') # in place change
+    assert preview(ip, 'int(test_arr[0])', '1') == '1'
+    ip.run_cell('del test_arr, test_bytes')
+    for block_name, nbytes in delta.shared['test_arr']:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(block_name) # unlinked
+
+def test_preview_shared_memory_full(monkeypatch):
+    import os, errno
+    import numpy as np
+    from previewer import dumps_shared
+    created = []
+    def posix_fallocate(fd, offset, length):
+        created.append(fd)
+        raise OSError(errno.ENOSPC, 'No space left on device')
+    monkeypatch.setattr(os, 'posix_fallocate', posix_fallocate, raising=False)
+    shared_pickle = dumps_shared(np.ones(1024 * 1024))
+    assert created and shared_pickle.blocks == [] # pickled in band instead
+    assert len(shared_pickle.data) > 8 * 1024 * 1024
+
+def test_preview_shared_crc_once(previewer_ip, monkeypatch):
+    import previewer
+    ip = previewer_ip
+    assert preview(ip, 'abs(3+3)', '6') == '6'
+    ip.run_cell('test_arr = np.arange(1000000)')
+    assert ip.previewer.standby is not None
+    crcs = []
+    buffer_crc = previewer.buffer_crc
+    monkeypatch.setattr(previewer, 'buffer_crc', lambda val: crcs.append(id(val)) or buffer_crc(val))
+    ip.run_cell('test_arr[0] = 1')
+    assert len(crcs) == 1 # shared by both processes
+    assert preview(ip, 'int(test_arr[0])', '1') == '1'
+    ip.run_cell('del test_arr')
+
+def test_preview_fast_path(previewer_ip, monkeypatch):
+    from calcpy import formatters
+    ip = previewer_ip
+    ip.run_cell('test_n = 4')
+    texts = ['2+3', '1/3', '2.5*test_n', '2^10', '-test_n**2 % 7', '2*pi', '(1+I)**2']
+    fast = [ip.previewer.fast_preview(ip.previewer.parse(text)) for text in texts]
+    assert fast[0] == '5'
+    for text in ['test_n(test_n+1)', '3!', 'x+1', '2**100**100', 'test_n = 5', 'print(1)']:
+        assert ip.previewer.fast_preview(ip.previewer.parse(text)) is None
+    for text, result in zip(texts, fast):
+        assert result == formatters.previewer_formatter(ip.run_cell(text).result) # as previewer with calcpy would show
+    sent = []
+    exec_conn_send = ip.previewer.exec_conn.send
+    monkeypatch.setattr(ip.previewer.exec_conn, 'send', lambda msg: sent.append(msg) or exec_conn_send(msg))
+    assert preview(ip, '7*6', '42') == '42'
+    assert sent == []
+    ip.run_cell('del test_n')
+
+def test_preview_skip(previewer_ip, monkeypatch):
+    ip = previewer_ip
+    sent = []
+    exec_conn_send = ip.previewer.exec_conn.send
+    monkeypatch.setattr(ip.previewer.exec_conn, 'send', lambda msg: sent.append(msg) or exec_conn_send(msg))
+    transformed = []
+    transform_cell = ip.transform_cell
+    monkeypatch.setattr(ip, 'transform_cell', lambda text: transformed.append(text) or transform_cell(text))
+    assert preview(ip, 'plot(x**2)', 'preview skipped (plot)') == 'preview skipped (plot)'
+    assert transformed.count('plot(x**2)') == 1 # parsed once for the fast path and the skip checks
+    assert preview(ip, 'x?', 'preview skipped (print_info)') == 'preview skipped (print_info)'
+    assert preview(ip, 'while True: pass', 'preview skipped (loop)') == 'preview skipped (loop)'
+    ip.run_cell('test_big = sum(x**k/factorial(k) for k in range(100))')
+    assert preview(ip, 'integrate(test_big, x)', 'preview skipped (large integrate)') == 'preview skipped (large integrate)'
+    assert sent == []
+    assert preview(ip, 'integrate(2*x, x) == x**2', 'True') == 'True'
+    ip.calcpy.previewer_skip_calls = []
+    assert ip.previewer.skip_reason(ip.previewer.parse('print_info(x)')) is None
+    ip.calcpy.previewer_skip_calls = ip.calcpy.trait_defaults('previewer_skip_calls')
+    ip.run_cell('del test_big')
+
+def wait_replaced(ip, active):
+    t = perf_counter()
+    while ip.previewer.active is active and perf_counter() - t < PREVIEW_TIMEOUT_SEC:
+        sleep(0.05)
+    return ip.previewer.active is not active
+
+def test_preview_recycle(previewer_ip, monkeypatch):
+    ip = previewer_ip
+    monkeypatch.setattr(ip.previewer, 'cpu_limit_sec', 1)
+    ip.previewer.restart() # new processes with cpu limit
+    ip.previewer.restart()
+    active = ip.previewer.active
+    assert preview(ip, 'abs(-1)', '1') == '1'
+    ip.pt_app.default_buffer.text = 'abs(2**10**10)' # in C, ctrl+c can't interrupt it
+    assert wait_replaced(ip, active)
+    assert not active.ip_proc.is_alive() # SIGXCPU
+    assert preview(ip, 'abs(-5)', '5') == '5'
+
+    active = ip.previewer.active
+    monkeypatch.setattr(ip.previewer, 'rss_limit_mb', 1)
+    assert wait_replaced(ip, active)
+    monkeypatch.undo()
+
+def test_preview_memory_limit(previewer_ip, monkeypatch):
+    ip = previewer_ip
+    monkeypatch.setattr(ip.previewer, 'memory_limit_mb', 100)
+    monkeypatch.setattr(ip.previewer, 'use_standby', False)
+    ip.previewer.restart()
+    ip.previewer.restart()
+    active = ip.previewer.active
+    assert preview(ip, 'abs(-1)', '1') == '1'
+    ip.run_cell('test_shared = np.ones(150*1024*1024 // 8)') # mapped from shared memory, not counted
+    assert preview(ip, 'int(test_shared[-1]) * test_shared.nbytes', '157286400') == '157286400'
+    ip.run_cell('del test_shared')
+    ip.pt_app.default_buffer.text = 'len(bytearray(200*1024*1024))' # MemoryError, previewer asks for restart
+    assert wait_replaced(ip, active)
+    monkeypatch.undo()
+    ip.previewer.restart()
+
+def test_preview_cpu_limit_clamped(monkeypatch):
+    resource = pytest.importorskip('resource')
+    from previewer import IPythonProcess
+    limits = []
+    monkeypatch.setattr(resource, 'getrlimit', lambda res: (resource.RLIM_INFINITY, 5))
+    monkeypatch.setattr(resource, 'setrlimit', lambda res, limit: limits.append((res, limit)))
+    proc = SimpleNamespace(cpu_limit_sec=10)
+    IPythonProcess.limit_cpu(proc, True)
+    IPythonProcess.limit_cpu(proc, False)
+    assert (resource.RLIMIT_CORE, (0, 0)) in limits # no core dump on SIGXCPU
+    # soft limit can't be over a finite hard limit
+    assert [limit for res, limit in limits if res == resource.RLIMIT_CPU] == [(5, 5), (5, 5)]
+
+def test_preview_stats(previewer_ip, tmp_path, capsys):
+    import json
+    from previewer import PREVIEW_STAGES
+    ip = previewer_ip
+    ip.calcpy.previewer_trace = str(tmp_path / 'trace.jsonl')
+    answered = ip.previewer.stats.counts['answered']
+    assert preview(ip, 'abs(-7)', '7') == '7'
+    assert preview(ip, '6*7', '42') == '42' # fast
+    assert preview(ip, 'plot(x)', 'preview skipped (plot)') == 'preview skipped (plot)'
+    assert ip.previewer.stats.counts['answered'] > answered
+    ip.calcpy.previewer_stats()
+    out = capsys.readouterr().out
+    for stage in PREVIEW_STAGES:
+        assert stage in out
+    assert 'answered' in out and 'timed out' in out
+    trace = [json.loads(line) for line in open(tmp_path / 'trace.jsonl')]
+    answer = [record for record in trace if record['text'] == 'abs(-7)'][0]
+    assert answer['outcome'] == 'answered'
+    stages_ms = [answer[f'{stage}_ms'] for stage in PREVIEW_STAGES if stage != 'total']
+    assert all(duration >= 0 for duration in stages_ms)
+    assert abs(sum(stages_ms) - answer['total_ms']) < 1
+    assert {'fast', 'skipped'} <= {record['outcome'] for record in trace}
+    ip.calcpy.previewer_trace = ''
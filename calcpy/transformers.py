@@ -1,9 +1,12 @@
 import ast
 import re
+import datetime
 import warnings
 import IPython
 import sympy
 import sympy.parsing.latex
+from calcpy.currency import SUPPORTED_CURRENCIES
+from calcpy.autostore import loaded
 
 # Auxilary classes for manipulations
 class UnitPrefix():
@@ -40,7 +43,8 @@ def parse_latex(s):
         return expr
     for sym in expr.free_symbols.copy():
         if sym.name in ip.user_ns:
-            expr = expr.subs(sym, ip.user_ns[sym.name])
+            # names in latex aren't seen by the lazy loader
+            expr = expr.subs(sym, loaded(ip.user_ns[sym.name]))
         else:
             ip.push({sym.name: sym})
     return expr
@@ -123,7 +127,7 @@ def raw_code_transformer(code):
            match[1] is not None:
             return match[0]
         if match[3] in user_vars:
-            if getattr(user_vars[match[3]], 'is_unit_prefix', False):
+            if getattr(type(user_vars[match[3]]), 'is_unit_prefix', False): # type only, nothing is loaded
                 return f'({match[2]}*{match[3]})'
             else:
                 return f'{match[2]}*{match[3]}'
@@ -244,6 +248,53 @@ class AutoProduct(AstNodeTransformer):
             return ast.BinOp(left=node.func, op=ast.Mult(), right=node.args[0])
         return self.generic_visit(node)
 
+def is_currency_name(var_name):
+    return var_name.upper() in SUPPORTED_CURRENCIES and var_name in [var_name.upper(), var_name.lower()]
+
+class CurrencyAtDate(AstNodeTransformer):
+    # convert '10USD @ d"2020-01-01"' to '(lambda _currency_date: 10*currency_at("USD", _currency_date))(dateparse("2020-01-01"))'
+    def is_currency(self, var_name):
+        currency_vars = getattr(self.ip.calcpy, '_currency_vars', {})
+        return is_currency_name(var_name) and var_name in currency_vars and \
+            self.ip.user_ns.get(var_name) is currency_vars[var_name]
+
+    def is_date(self, node):
+        if isinstance(node, ast.Call):
+            func = node.func
+            return (isinstance(func, ast.Name) and func.id in ['dateparse', 'date', 'datetime']) or \
+                (isinstance(func, ast.Attribute) and func.attr in ['date', 'datetime', 'today', 'now', 'fromisoformat'])
+        if isinstance(node, ast.Name):
+            return isinstance(self.ip.user_ns.get(node.id), datetime.date)
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            try:
+                datetime.date.fromisoformat(node.value)
+                return True
+            except ValueError:
+                return False
+        return False
+
+    def visit_BinOp(self, node):
+        node = self.generic_visit(node)
+        if not isinstance(node.op, ast.MatMult) or not self.is_date(node.right):
+            return node
+        currency_names = [n.id for n in ast.walk(node.left) if isinstance(n, ast.Name) and is_currency_name(n.id)]
+        if not currency_names or not all(self.is_currency(name) for name in currency_names):
+            return node
+        is_currency = self.is_currency
+
+        class ReplaceCurrencyNames(ast.NodeTransformer):
+            def visit_Name(self, name_node):
+                if isinstance(name_node.ctx, ast.Load) and is_currency(name_node.id):
+                    return ast.Call(func=ast.Name(id='currency_at', ctx=ast.Load()),
+                                    args=[ast.Constant(name_node.id.upper()), ast.Name(id='_currency_date', ctx=ast.Load())],
+                                    keywords=[])
+                return name_node
+
+        body = ReplaceCurrencyNames().visit(node.left)
+        func = ast.Lambda(args=ast.arguments(posonlyargs=[], args=[ast.arg(arg='_currency_date')], kwonlyargs=[], kw_defaults=[], defaults=[]),
+                          body=body)
+        return ast.Call(func=func, args=[node.right], keywords=[])
+
 def init(ip: IPython.InteractiveShell):
     ip.calcpy.push({'_factorial_pow': FactorialPow()}, interactive=False)
 
@@ -256,6 +307,7 @@ def init(ip: IPython.InteractiveShell):
     ip.ast_transformers.append(ReplaceFloatWithRational(ip))
     ip.ast_transformers.append(ReplaceTupleWithMatrix(ip))
     ip.ast_transformers.append(AutoProduct(ip))
+    ip.ast_transformers.append(CurrencyAtDate(ip))
     ip.input_transformers_post.append(calcpy_input_transformer_post)
 
     # monkey patches
@@ -6,18 +6,272 @@ if mp.current_process().name == 'ipython_previewer':
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 import threading
+import _thread
 import os
 import io
 import ast
 import sys
+import pickle
+import importlib
+import inspect
+import copy
+import zlib
+import numbers
+import atexit
+import json
+import re
+from multiprocessing import shared_memory
+from time import perf_counter, time
+from collections import namedtuple, OrderedDict
 from types import ModuleType
 import IPython
 from prompt_toolkit.styles import Style, merge_styles
+try:
+    import resource
+except ModuleNotFoundError: # windows
+    resource = None
 from traitlets.config.loader import Config
 
 CTRL_C_TIMEOUT = 2
 RESTART_TIMEOUT = 10
+MONITOR_INTERVAL_SEC = 0.5
+NS_IDLE_POLL_SEC = 0.05 # namespace deltas are applied while waiting for requests
+# previews are sent after a delay proportional to recent evaluation time, so fast typing doesn't queue slow evaluations
+DEBOUNCE_COST_RATIO = 0.5
+DEBOUNCE_MIN_SEC = 0.01
+DEBOUNCE_MAX_SEC = 0.25
+EVAL_COST_EMA_WEIGHT = 0.2
+PREVIEW_CACHE_SIZE = 128
+# trivial arithmetic is evaluated in the shell itself, bounded so it stays trivial
+FAST_PREVIEW_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+FAST_PREVIEW_MAX_EXPONENT = 64
+FAST_PREVIEW_MAX_BITS = 4096
+# calls that are slow for large arguments, previewed only when arguments are small
+PREVIEW_SIZE_LIMITED_CALLS = ['integrate', 'dsolve', 'solve', 'nonlinsolve', 'simplify', 'limit', 'summation', 'product', 'series']
+PREVIEW_MAX_ARGS_SIZE = 200
+PREVIEW_SKIPPED = 'preview skipped ({})'
+STATS_BUCKETS_SEC = [0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1, 3]
+PREVIEW_STAGES = ['debounce', 'send', 'queue', 'transform', 'execute', 'format', 'receive', 'total']
+PREVIEW_OUTCOMES = ['answered', 'fast', 'cached', 'skipped', 'dropped', 'cancelled', 'timed_out', 'restarted']
+SHM_MIN_BYTES = 1024 * 1024 # larger arrays and bytes are sent through shared memory, not through the pipe
+# imported once by the forkserver, instead of by every previewer process
+PRELOAD_MODULES = ['numpy', 'sympy', 'IPython.terminal.ipapp']
 NS_BLOCK_LIST = ['open', 'exit', 'quit', 'get_ipython', 'calcpy']
+NS_NO_SYNC_LIST = ['In', 'Out', '_ih', '_oh', '_dh'] # history, previewer has its own
+NS_HISTORY_NAMES = ['_', '__', '___', '_i', '_ii', '_iii'] # and _N, _iN, sent once per cell as HistoryEntry
+# a cell using these may change any variable in place
+NS_UNTRACKED_NAMES = ['get_ipython', 'exec', 'eval', 'globals', 'vars', 'locals', 'setattr', '__import__']
+
+# namespace changes since previous generation: sources of shell defined functions and classes,
+# cell to re-execute when some value can't be pickled, deleted names and pickled variables (in that order)
+ExecRequest = namedtuple('ExecRequest', ['code', 'assign', 'preview', 'generation', 'id'])
+# perf_counter times of a preview request, comparable with previewer's (system wide monotonic clock)
+SentPreview = namedtuple('SentPreview', ['text', 'generation', 'requested', 'sending', 'sent'])
+# shared is {var_name: [(block_name, nbytes)]}, out of band buffers of pickled_vars[var_name]
+NsDelta = namedtuple('NsDelta', ['generation', 'pickled_vars', 'deleted', 'sources', 'cell', 'shared'], defaults=[(), None, {}])
+# input and output of a cell stored in history, has_result is False when it had no output
+HistoryEntry = namedtuple('HistoryEntry', ['count', 'cell', 'has_result', 'result'])
+# blocks is [(SharedMemory, nbytes)], val is kept so its id isn't reused while blocks are alive
+SharedPickle = namedtuple('SharedPickle', ['val', 'data', 'blocks'])
+
+def is_history_name(var_name):
+    return var_name in NS_HISTORY_NAMES or re.fullmatch(r'_i?\d+', var_name) is not None
+
+def is_mutable(val):
+    return type(val).__hash__ in [None, object.__hash__] and \
+        not (inspect.isroutine(val) or inspect.isclass(val) or isinstance(val, ModuleType))
+
+def is_pickled_by_name(val):
+    '''functions and classes defined in the shell, the previewer has no such names to unpickle by'''
+    return (inspect.isfunction(val) or inspect.isclass(val)) and getattr(val, '__module__', None) == '__main__'
+
+def previewer_start_method(preload=()):
+    '''previewer starts from a fresh interpreter, so no memory leftovers (e.g. traitlets singletons).
+    on linux it is forked from a forkserver that already imported the heavy modules.
+    multiprocessing has a single forkserver, so user's forkserver processes are started from it too
+    (with these modules imported)'''
+    if sys.platform == 'linux':
+        mp.set_forkserver_preload(PRELOAD_MODULES + list(preload)) # no effect once forkserver is running
+        return 'forkserver'
+    return 'spawn'
+
+def is_fast_number(val):
+    '''python numbers and sympy numeric atoms (Integer, Float, pi, I...), checked on the type so nothing is evaluated'''
+    if isinstance(val, numbers.Integral):
+        return abs(int(val)).bit_length() <= FAST_PREVIEW_MAX_BITS
+    return isinstance(val, numbers.Number) or \
+        (getattr(type(val), 'is_number', None) is True and getattr(type(val), 'is_Atom', None) is True)
+
+def is_fast_expr(node, user_ns):
+    '''arithmetic of numeric literals and names bound to numbers'''
+    if isinstance(node, ast.Constant):
+        return type(node.value) in (int, float, complex)
+    if isinstance(node, ast.Name):
+        return is_fast_number(user_ns.get(node.id))
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, (ast.UAdd, ast.USub)) and is_fast_expr(node.operand, user_ns)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+        # small literal exponent of a base without powers, so no huge results
+        exponent = node.right.operand if isinstance(node.right, ast.UnaryOp) else node.right
+        return isinstance(exponent, ast.Constant) and type(exponent.value) is int and exponent.value <= FAST_PREVIEW_MAX_EXPONENT and \
+            is_fast_expr(node.right, user_ns) and is_fast_expr(node.left, user_ns) and \
+            not any(isinstance(child, ast.BinOp) and isinstance(child.op, ast.Pow) for child in ast.walk(node.left))
+    if isinstance(node, ast.BinOp):
+        return isinstance(node.op, FAST_PREVIEW_BINOPS) and is_fast_expr(node.left, user_ns) and is_fast_expr(node.right, user_ns)
+    return False
+
+def expr_size(val, limit):
+    '''number of nodes in a sympy-like expression tree, counting up to limit'''
+    size = 0
+    stack = [val]
+    while stack and size < limit:
+        node = stack.pop()
+        size += 1
+        if isinstance(getattr(type(node), 'args', None), property):
+            stack.extend(node.args)
+    return size
+
+def call_name(node):
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr
+    return None
+
+def is_shareable(val):
+    if isinstance(val, (bytes, bytearray)):
+        return len(val) >= SHM_MIN_BYTES
+    np = sys.modules.get('numpy') # no arrays unless numpy was imported
+    return np is not None and isinstance(val, np.ndarray) and val.dtype.kind in 'biufc' and val.nbytes >= SHM_MIN_BYTES
+
+def buffer_crc(val):
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(val, np.ndarray):
+        val = np.ascontiguousarray(val).view(np.uint8) # any layout and dtype (e.g. datetime64)
+    return zlib.crc32(val)
+
+def code_names(code):
+    '''global and attribute names used by code and its nested functions'''
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= code_names(const)
+    return names
+
+def shell_functions(val):
+    '''functions defined in the shell that val may call, its own or its class's methods'''
+    if inspect.isfunction(val):
+        return [val]
+    cls = val if inspect.isclass(val) else type(val)
+    if getattr(cls, '__module__', None) == '__main__':
+        return [attr for attr in vars(cls).values() if inspect.isfunction(attr)]
+    return []
+
+def touched_names(ip, cell):
+    '''names a cell may have changed in place: the names it uses, globals of the shell functions it calls
+    and names bound to the same objects. None when it can't tell (e.g. magics, exec)'''
+    try:
+        tree = ast.parse(ip.transform_cell(cell))
+    except Exception:
+        return None
+    names = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+    pending = list(names)
+    while pending:
+        for func in shell_functions(ip.user_ns.get(pending.pop())):
+            new_names = code_names(func.__code__) - names
+            names |= new_names
+            pending += new_names
+    if names & set(NS_UNTRACKED_NAMES):
+        return None
+    ids = {id(ip.user_ns[name]) for name in names if name in ip.user_ns}
+    return names | {name for name, val in ip.user_ns.items() if id(val) in ids}
+
+class CellPickles():
+    '''pickles and buffer crcs of the values after a cell, shared by previewer processes and autostore,
+    so each value is pickled once. names not touched by the cell (all when touched is None) and bound
+    to the same object since the previous cell are not changed in place'''
+    def __init__(self, result=None, touched=None):
+        self.result = result
+        self.touched = touched
+        self.pickled = {} # id: (val, pickled or exception), val is kept so its id isn't reused
+        self.crcs = {}
+
+    def is_touched(self, var_name):
+        return self.touched is None or var_name in self.touched
+
+    def dumps(self, val):
+        '''pickle.dumps(val), or the exception it raised'''
+        if id(val) not in self.pickled:
+            try:
+                self.pickled[id(val)] = (val, pickle.dumps(val))
+            except Exception as e:
+                self.pickled[id(val)] = (val, e)
+        return self.pickled[id(val)][1]
+
+    def crc(self, val):
+        if id(val) not in self.crcs:
+            self.crcs[id(val)] = (val, buffer_crc(val))
+        return self.crcs[id(val)][1]
+
+def cell_pickles(ip, result=None):
+    '''CellPickles of the cell of result, created by the first post_run_cell handler to ask for it'''
+    if result is None:
+        return CellPickles()
+    pickles = getattr(ip, 'cell_pickles', None)
+    if pickles is None or pickles.result is not result:
+        if pickles is None:
+            ip.events.register('pre_run_cell', lambda info: setattr(ip, 'cell_pickles', CellPickles())) # don't keep them
+        pickles = ip.cell_pickles = CellPickles(result, touched_names(ip, result.info.raw_cell))
+    return pickles
+
+class OutOfBandBytes():
+    '''bytes or bytearray pickled with its buffer out of band, loaded back as a copy of its own type'''
+    def __init__(self, val):
+        self.val = val
+
+    def __reduce_ex__(self, protocol):
+        return type(self.val), (pickle.PickleBuffer(self.val),)
+
+def dumps_shared(val):
+    '''pickle protocol 5, with out of band buffers copied to new shared memory blocks'''
+    blocks = []
+    def buffer_callback(pickle_buffer):
+        raw = pickle_buffer.raw()
+        shm = shared_memory.SharedMemory(create=True, size=max(raw.nbytes, 1))
+        blocks.append((shm, raw.nbytes))
+        if hasattr(os, 'posix_fallocate'):
+            # block is a sparse file, writing to it when /dev/shm is full would SIGBUS instead of raising
+            os.posix_fallocate(shm._fd, 0, shm.size)
+        shm.buf[:raw.nbytes] = raw
+        return False
+    try:
+        data = pickle.dumps(OutOfBandBytes(val) if isinstance(val, (bytes, bytearray)) else val,
+                            protocol=5, buffer_callback=buffer_callback)
+    except OSError: # no shared memory (e.g. /dev/shm is full)
+        for shm, nbytes in blocks:
+            shm.close()
+            shm.unlink()
+        return SharedPickle(val, pickle.dumps(val), [])
+    return SharedPickle(val, data, blocks)
+
+def loads_shared(data, blocks):
+    '''returns value and the SharedMemory objects its buffers (read only, not copied) are in'''
+    shms = []
+    try:
+        for block_name, nbytes in blocks:
+            shms.append(shared_memory.SharedMemory(block_name))
+        val = pickle.loads(data, buffers=[shm.buf[:nbytes].toreadonly() for shm, (block_name, nbytes) in zip(shms, blocks)])
+    except Exception:
+        for shm in shms:
+            shm.close()
+        raise
+    return val, shms
+
+def send(conn, msg):
+    try:
+        conn.send(msg)
+    except OSError:
+        pass # process died, monitor replaces it
 
 class PipeListener(threading.Thread):
     def __init__(self, conn, cb):
@@ -34,6 +288,51 @@ class PipeListener(threading.Thread):
                 return # pipe closed
             self.cb(msg)
 
+class Timestamp(ast.NodeTransformer):
+    '''last ast transformer, marks the time transformations ended'''
+    time = None
+
+    def visit(self, node):
+        self.time = perf_counter()
+        return node
+
+class PreviewStats():
+    '''histograms of preview stages durations, counts of outcomes, and optional JSONL trace'''
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+        self.histograms = {stage: [0] * (len(STATS_BUCKETS_SEC) + 1) for stage in PREVIEW_STAGES}
+        self.sums = dict.fromkeys(PREVIEW_STAGES, 0)
+        self.counts = dict.fromkeys(PREVIEW_OUTCOMES, 0)
+        self.lock = threading.Lock()
+
+    def add(self, outcome, text=None, durations={}):
+        with self.lock:
+            self.counts[outcome] += 1
+            for stage, duration in durations.items():
+                bucket = sum(duration >= bucket_sec for bucket_sec in STATS_BUCKETS_SEC)
+                self.histograms[stage][bucket] += 1
+                self.sums[stage] += duration
+        if self.trace_path:
+            try:
+                with open(self.trace_path, 'a') as f:
+                    f.write(json.dumps({'time': time(), 'outcome': outcome, 'text': text,
+                                        **{f'{stage}_ms': duration * 1000 for stage, duration in durations.items()}}) + '\n')
+            except OSError as e:
+                print(f'Failed to write previewer trace to {self.trace_path}: {repr(e)}')
+                self.trace_path = None
+
+    def print(self):
+        labels = [f'<{bucket_sec*1000:g}ms' if bucket_sec < 1 else f'<{bucket_sec:g}s' for bucket_sec in STATS_BUCKETS_SEC] + \
+                 [f'>={STATS_BUCKETS_SEC[-1]:g}s']
+        width = max(len(label) for label in labels)
+        print(f'{"Stage":<10}' + ''.join(f'{label:>{width+1}}' for label in labels) + f'{"Mean":>10}')
+        with self.lock:
+            for stage in PREVIEW_STAGES:
+                count = sum(self.histograms[stage])
+                mean = f'{self.sums[stage] / count * 1000:.2f}ms' if count else ''
+                print(f'{stage:<10}' + ''.join(f'{n:>{width+1}}' for n in self.histograms[stage]) + f'{mean:>10}')
+            print(', '.join(f'{outcome.replace("_", " ")} {n}' for outcome, n in self.counts.items()))
+
 class DisableAssignments(ast.NodeTransformer):
     def __init__(self, active):
         super().__init__()
@@ -56,8 +355,13 @@ class DisableAssignments(ast.NodeTransformer):
         return self.generic_visit(node)
 
 class IPythonProcess(mp.Process):
-    def __init__(self, exec_conn, ctrl_conn, ns_conn, config=Config(), formatter=str, debug=False, stdout_path=None, interactive=False):
+    def __init__(self, exec_conn, ctrl_conn, ns_conn, config=Config(), formatter=str, debug=False, stdout_path=None, interactive=False, baseline_modules=(), start_method='spawn',
+                 memory_limit_mb=0, cpu_limit_sec=0):
         super().__init__(name='ipython_previewer', daemon=True)
+        # address space previewer may grow by after initialization, cpu time of a preview, 0 for no limit
+        self.memory_limit_mb = memory_limit_mb
+        self.cpu_limit_sec = cpu_limit_sec
+        self.start_method = start_method
         self.exec_conn = exec_conn
         self.ctrl_conn = ctrl_conn
         self.ns_conn = ns_conn
@@ -66,9 +370,14 @@ class IPythonProcess(mp.Process):
         self.debug = debug
         self.stdout_path = stdout_path
         self.interactive = interactive
+        self.baseline_modules = baseline_modules
         self._open = io.open
         self.start()
 
+    def _Popen(self, process_obj):
+        # start method of our own, without changing the global one used by user's code
+        return mp.get_context(self.start_method).Process._Popen(process_obj)
+
     def sandbox_pre(self):
         for module_name in ['tkinter', 'pyperclip', 'PyQt5', 'PyQt6', 'PySide2', 'PySide6', 'GLib', 'Gtk', 'gi']:
             sys.modules[module_name] = None
@@ -117,20 +426,85 @@ class IPythonProcess(mp.Process):
         self.config.TerminalInteractiveShell.xmode = 'Minimal'
         self.config.HistoryAccessor.enabled = False
         self.ipapp = IPython.terminal.ipapp.TerminalIPythonApp.instance(config=self.config)
-        self.ipapp.initialize()
+        self.ipapp.initialize(argv=[]) # parent's command line is not for us
         self.previewer_ip = self.ipapp.shell
         self.previewer_ip.inspector = None # inspector is calling expensive operations
+        self.ns_generation = 0
+        self.ns_received_generation = 0
+        self.ns_deltas = []
+        self.ns_cond = threading.Condition()
+        self.shared_blocks = {} # var_name: [SharedMemory] its value is mapped from
+        self.unreleased_blocks = [] # value is still referenced elsewhere
+        self.vm_size = None # address space after initialization
         self.disable_assign = DisableAssignments(False)
         self.previewer_ip.ast_transformers.append(self.disable_assign)
+        self.timestamp = Timestamp()
+        self.previewer_ip.ast_transformers.append(self.timestamp)
+        self.timed_out = False
+        self.interrupted = False
+        # id of preview being evaluated, so it can be interrupted when newer text arrives
+        self.running_id = None
+        self.running_lock = threading.Lock()
+        self.ctrl_send_lock = threading.Lock()
+        self.ctrl_thread = PipeListener(self.ctrl_conn, self.ctrl_cb)
+        # same star imports as parent, before any namespace sync could be overridden by them
+        for module_name in self.baseline_modules:
+            self.previewer_ip.run_cell(f'from {module_name} import *', store_history=False)
         self.ns_thread = threading.Thread(target=self.ns_job, daemon=True, name='ns_job')
         self.ns_thread.start()
 
         self.sandbox_post()
+        self.limit_memory()
+
+    def limit_memory(self, incoming=0):
+        '''allocations beyond the limit raise MemoryError.
+        shared memory blocks mapped from parent (and incoming bytes about to be mapped) are added to the limit'''
+        if resource is None or not self.memory_limit_mb:
+            return
+        try:
+            if self.vm_size is None:
+                with self._open('/proc/self/statm') as f:
+                    self.vm_size = int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+            shared = sum(shm.size for shms in self.shared_blocks.values() for shm in shms) + \
+                     sum(shm.size for shm in self.unreleased_blocks)
+            limit = self.vm_size + int(self.memory_limit_mb * 1024 * 1024) + shared + incoming
+            hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+            if hard != resource.RLIM_INFINITY:
+                limit = min(limit, hard)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+        except (OSError, ValueError) as e:
+            print(f'memory limit error: {repr(e)}')
+
+    def limit_cpu(self, limited):
+        '''SIGXCPU terminates us when preview's cpu time exceeds limit, even inside C code ctrl+c can't interrupt'''
+        if resource is None or not self.cpu_limit_sec:
+            return
+        try:
+            soft, hard = resource.RLIM_INFINITY, resource.getrlimit(resource.RLIMIT_CPU)[1]
+            if limited:
+                resource.setrlimit(resource.RLIMIT_CORE, (0, 0)) # SIGXCPU's default action dumps core
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                soft = int(usage.ru_utime + usage.ru_stime + self.cpu_limit_sec) + 1
+            if hard != resource.RLIM_INFINITY and (soft == resource.RLIM_INFINITY or soft > hard):
+                soft = hard
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+        except (OSError, ValueError) as e:
+            print(f'cpu limit error: {repr(e)}')
 
     def ns_job(self):
         while True:
             try:
                 ns_msg = self.ns_conn.recv()
+                if isinstance(ns_msg, NsDelta):
+                    # applied by the main loop, not while code is running
+                    with self.ns_cond:
+                        self.ns_deltas.append(ns_msg)
+                        self.ns_received_generation = ns_msg.generation
+                        self.ns_cond.notify_all()
+                    continue
+                if isinstance(ns_msg, HistoryEntry):
+                    self.add_history(ns_msg)
+                    continue
                 if ns_msg[0] in NS_BLOCK_LIST:
                     continue
                 if len(ns_msg) == 2:
@@ -142,15 +516,91 @@ class IPythonProcess(mp.Process):
             except Exception as e:
                 print(f'ns error: {repr(e)}')
 
+    def add_history(self, entry):
+        '''same names the shell's history sets, without the values being sent again for each of them'''
+        user_ns = self.previewer_ip.user_ns
+        user_ns.update({'_iii': user_ns.get('_ii', ''), '_ii': user_ns.get('_i', ''),
+                        '_i': entry.cell, f'_i{entry.count}': entry.cell})
+        if entry.has_result:
+            user_ns['Out'][entry.count] = entry.result
+            user_ns.update({'___': user_ns.get('__', ''), '__': user_ns.get('_', ''),
+                            '_': entry.result, f'_{entry.count}': entry.result})
+
+    def apply_ns_deltas(self):
+        with self.ns_cond:
+            ns_deltas, self.ns_deltas = self.ns_deltas, []
+        for ns_delta in ns_deltas:
+            self.update_ns(ns_delta)
+
+    def update_ns(self, ns_delta):
+        if ns_delta.shared:
+            self.limit_memory(sum(nbytes for blocks in ns_delta.shared.values() for block_name, nbytes in blocks))
+        for source in ns_delta.sources:
+            self.run_code(source, assign=True)
+        if ns_delta.cell is not None:
+            self.run_code(ns_delta.cell, assign=True)
+        for var_name in ns_delta.deleted:
+            if var_name not in NS_BLOCK_LIST:
+                self.previewer_ip.user_ns.pop(var_name, None)
+                self.release_shared(var_name)
+        for var_name, pickled_val in ns_delta.pickled_vars.items():
+            if var_name in NS_BLOCK_LIST:
+                continue
+            shms = []
+            try:
+                self.previewer_ip.user_ns[var_name], shms = loads_shared(pickled_val, ns_delta.shared.get(var_name, []))
+            except Exception as e:
+                print(f'ns error {var_name}: {repr(e)}')
+                self.previewer_ip.user_ns.pop(var_name, None)
+            self.release_shared(var_name)
+            if shms:
+                self.shared_blocks[var_name] = shms
+        if ns_delta.shared:
+            self.ctrl_send(('mapped', ns_delta.generation)) # parent can unlink the blocks
+        if ns_delta.shared or ns_delta.deleted:
+            self.limit_memory() # only the blocks still mapped
+        self.ns_generation = ns_delta.generation
+
+    def release_shared(self, var_name):
+        '''unmap blocks of a replaced value, parent unlinks them'''
+        blocks = self.unreleased_blocks + self.shared_blocks.pop(var_name, [])
+        self.unreleased_blocks = []
+        for shm in blocks:
+            try:
+                shm.close()
+            except BufferError:
+                self.unreleased_blocks.append(shm)
+
     def ask_restart(self):
         print('asking restart')
-        self.ctrl_conn.send('restart')
+        self.ctrl_send('restart')
+
+    def ctrl_send(self, ctrl_msg):
+        with self.ctrl_send_lock: # from main and timer threads
+            send(self.ctrl_conn, ctrl_msg)
 
     def ctrl_c(self):
-        print('sending SIGINT')
-        signal.raise_signal(signal.SIGINT)
+        print('interrupting')
+        # formatters may swallow KeyboardInterrupt, result is dropped anyway
+        self.interrupted = True
+        try:
+            _thread.interrupt_main() # ignored unless ctrl+c is unmasked
+        except TypeError:
+            pass # python < 3.10 calls the handler even when it is SIG_IGN
+
+    def time_out(self):
+        self.timed_out = True
+        self.ctrl_c()
+
+    def ctrl_cb(self, ctrl_msg):
+        if ctrl_msg[0] == 'interrupt':
+            with self.running_lock:
+                if self.running_id is not None and self.running_id < ctrl_msg[1]:
+                    self.ctrl_c()
 
     def run(self):
+        # forkserver restores the default handler in its children, the mask at import is not enough
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
         if self.interactive:
             sys.stdin = open(0)
             self.stdout = sys.stdout
@@ -170,43 +620,228 @@ class IPythonProcess(mp.Process):
             return
 
         while True:
+            timers = []
             try:
-                code, assign, do_preview = self.exec_conn.recv()
-                while self.exec_conn.poll(): # take only latest
-                    code, assign, do_preview = self.exec_conn.recv()
+                while not self.exec_conn.poll(NS_IDLE_POLL_SEC):
+                    self.apply_ns_deltas() # standby gets no requests, but should be synced when swapped in
+                request = self.exec_conn.recv()
+                while self.exec_conn.poll(): # take only latest preview
+                    if request.assign:
+                        self.run_code(request.code, request.assign)
+                    request = self.exec_conn.recv()
+                # namespace should be as it was when code was sent
+                with self.ns_cond:
+                    self.ns_cond.wait_for(lambda: self.ns_received_generation >= request.generation, timeout=CTRL_C_TIMEOUT)
+                self.apply_ns_deltas()
                 # unmask ctrl+c
                 signal.signal(signal.SIGINT, signal.default_int_handler)
-                ctrl_c_timer = threading.Timer(CTRL_C_TIMEOUT, self.ctrl_c)
-                restart_timer = threading.Timer(RESTART_TIMEOUT, self.ask_restart)
-                ctrl_c_timer.start(),  restart_timer.start()
-                result = self.run_code(code, assign)
-                ctrl_c_timer.cancel(), restart_timer.cancel()
-                if do_preview:
-                    self.exec_conn.send(result)
+                self.timed_out = False
+                self.interrupted = False
+                timers = [threading.Timer(CTRL_C_TIMEOUT, self.time_out), threading.Timer(RESTART_TIMEOUT, self.ask_restart)]
+                for timer in timers:
+                    timer.start()
+                if request.preview:
+                    with self.running_lock:
+                        self.running_id = request.id
+                    self.limit_cpu(True)
+                t = perf_counter()
+                result = self.run_code(request.code, request.assign)
+                elapsed = perf_counter() - t
+                self.limit_cpu(False)
+                with self.running_lock:
+                    self.running_id = None
+                    signal.signal(signal.SIGINT, signal.SIG_IGN)
+                    if self.interrupted:
+                        result = None
+                if request.preview:
+                    self.exec_conn.send((request.id, result, elapsed,
+                                         dict(self.timings, timed_out=self.timed_out, sent=perf_counter())))
             except (EOFError, OSError):
                 return # pipe closed
+            except KeyboardInterrupt:
+                pass # interrupt arrived right after evaluation ended
             except Exception as e:
                 print(f'previewer run cell error: {repr(e)}')
             finally:
+                # also when interrupted outside of run_cell, so the timers won't time out the next request
+                for timer in timers:
+                    timer.cancel()
                 signal.signal(signal.SIGINT, signal.SIG_IGN)
+                self.limit_cpu(False)
 
     def run_code(self, code, assign):
         self.disable_assign.active = not assign
         print(f'In [1]: {code}')
+        self.timestamp.time = None
+        self.timings = {'start': perf_counter()}
         result = self.previewer_ip.run_cell(code, store_history=False)
-        if result.result is None:
-            return ''
-        return self.formatter(result.result)
+        self.timings['executed'] = perf_counter()
+        self.timings['transformed'] = self.timestamp.time or self.timings['executed'] # not set if transformation failed
+        if isinstance(result.error_in_exec, KeyboardInterrupt):
+            return None
+        if isinstance(result.error_in_exec, MemoryError):
+            self.ask_restart() # memory limit reached, heap is likely fragmented
+        formatted = '' if result.result is None else self.formatter(result.result)
+        self.timings['formatted'] = perf_counter()
+        return formatted
+
+def star_exports(module_name):
+    '''{name: value} that 'from module_name import *' would import'''
+    module = importlib.import_module(module_name)
+    names = getattr(module, '__all__', [name for name in vars(module) if not name.startswith('_')])
+    return {name: getattr(module, name) for name in names}
+
+class PreviewerProcess():
+    '''previewer process with its pipes and the namespace state that was sent to it'''
+    def __init__(self, previewer):
+        self.previewer = previewer
+        self.exec_conn, exec_conn_c = mp.Pipe()
+        self.ctrl_conn, ctrl_conn_c = mp.Pipe()
+        self.ns_conn, ns_conn_c = mp.Pipe()
+        # var_name: (value as last sent to the previewer (or found unpicklable), crc of mutable value)
+        self.synced = {}
+        # var_names that were pushed or deleted, so previewer's baseline value is not there
+        self.diverged = set()
+        # var_name: (key of previewer.shared_pickles its value was sent by, generation), until mapped by the process
+        self.shared = {}
+        self.generation = 0
+        self.ready = False # answered a preview
+        self.preview_thread = PipeListener(self.exec_conn, self.preview_cb)
+        self.ctrl_thread = PipeListener(self.ctrl_conn, self.ctrl_cb)
+        self.ip_proc = IPythonProcess(exec_conn_c, ctrl_conn_c, ns_conn_c,
+            config=previewer.config, formatter=previewer.formatter, debug=previewer.debug, stdout_path=previewer.stdout_path,
+            baseline_modules=previewer.baseline_modules, start_method=previewer.start_method,
+            memory_limit_mb=previewer.memory_limit_mb, cpu_limit_sec=previewer.cpu_limit_sec)
+
+    def close(self):
+        self.exec_conn.close()
+        self.ctrl_conn.close()
+        self.ns_conn.close()
+        self.ip_proc.terminate()
+
+    def preview_cb(self, preview_msg):
+        self.ready = True
+        if self is self.previewer.active:
+            self.previewer.preview_cb(preview_msg)
+
+    def ctrl_cb(self, ctrl_msg):
+        self.previewer.ctrl_cb(ctrl_msg, self)
+
+    def rss_mb(self):
+        '''anonymous resident memory, shared memory blocks mapped from parent are not counted, 0 without /proc'''
+        try:
+            with open(f'/proc/{self.ip_proc.pid}/status') as f:
+                for line in f:
+                    if line.startswith('RssAnon:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return 0
+
+    def sync(self, user_ns, cell=None, new_generation=False, pickles=None):
+        if pickles is None:
+            pickles = CellPickles()
+        initial = self.generation == 0 # history so far, later cells come by push_history
+        changed = {}
+        for var_name, val in user_ns.items():
+            if var_name in NS_NO_SYNC_LIST or (not initial and is_history_name(var_name)):
+                continue
+            if var_name in self.synced and self.synced[var_name][0] is val and \
+             (not is_mutable(val) or not pickles.is_touched(var_name)):
+                continue
+            if var_name in self.previewer.baseline and self.previewer.baseline[var_name] is val and var_name not in self.diverged:
+                self.synced[var_name] = (val, None)
+                continue
+            changed[var_name] = val
+        deleted = [var_name for var_name in self.synced if var_name not in user_ns]
+        self.push(changed, deleted, cell, new_generation, pickles)
+
+    def push(self, variables, deleted=[], cell=None, new_generation=True, pickles=None):
+        '''pickles caches pickle.dumps results and buffer crcs, for pushing the same values to several processes'''
+        if pickles is None:
+            pickles = CellPickles()
+        pickled_vars = {}
+        shared = {}
+        sources = []
+        unpicklable = []
+        for var_name, val in variables.items():
+            prev_val, prev_crc = self.synced.get(var_name, (None, None))
+            self.synced[var_name] = (val, None)
+            if var_name in NS_BLOCK_LIST or isinstance(val, ModuleType):
+                continue
+            if is_pickled_by_name(val):
+                if val is not prev_val:
+                    try:
+                        sources.append(inspect.getsource(val))
+                    except Exception:
+                        unpicklable.append(var_name)
+                continue
+            if is_shareable(val):
+                crc = pickles.crc(val)
+                self.synced[var_name] = (val, crc)
+                if val is prev_val and crc == prev_crc:
+                    continue
+                key = (id(val), crc)
+                if key not in self.previewer.shared_pickles:
+                    self.previewer.shared_pickles[key] = dumps_shared(val)
+                pickled_vars[var_name] = self.previewer.shared_pickles[key].data
+                shared[var_name] = key
+                continue
+            pickled_val = pickles.dumps(val)
+            if isinstance(pickled_val, Exception):
+                if val is prev_val:
+                    continue
+                if self.previewer.debug and var_name != 'Out':
+                    pickled_vars[var_name] = pickle.dumps(repr(pickled_val))
+                else:
+                    unpicklable.append(var_name)
+                continue
+            if is_mutable(val):
+                crc = zlib.crc32(pickled_val)
+                self.synced[var_name] = (val, crc)
+                if val is prev_val and crc == prev_crc:
+                    continue # not changed in place
+            pickled_vars[var_name] = pickled_val
+        if unpicklable and cell is None:
+            deleted = list(deleted) + unpicklable # don't leave previous value
+        for var_name in deleted:
+            if var_name not in variables:
+                self.synced.pop(var_name, None)
+        for var_name in [*pickled_vars, *deleted, *unpicklable]:
+            self.shared.pop(var_name, None)
+        self.diverged.update(pickled_vars, deleted, unpicklable)
+        if pickled_vars or deleted or sources or unpicklable or new_generation:
+            self.generation += 1
+            self.shared.update({var_name: (key, self.generation) for var_name, key in shared.items()})
+            send(self.ns_conn, NsDelta(self.generation, pickled_vars, deleted, sources,
+                                       cell if unpicklable else None,
+                                       {var_name: [(shm.name, nbytes) for shm, nbytes in self.previewer.shared_pickles[key].blocks]
+                                        for var_name, key in shared.items()}))
 
 class Previewer():
-    def __init__(self, ip, config=Config(), formatter=str, debug=False):
-        # spawn, so no memory leftovers (e.g. traitlets singletons)
-        mp.set_start_method('spawn', force=True)
+    def __init__(self, ip, config=Config(), formatter=str, debug=False, baseline_modules=(), standby=True, skip_calls=(),
+                 memory_limit_mb=0, cpu_limit_sec=0, rss_limit_mb=0, trace_path=None):
         self.ip = ip
         self.config = ip.config.copy()
         self.config.merge(config)
         self.formatter = formatter
         self.debug = debug
+        # previewer imports these by itself, their values are not pushed unless rebound
+        self.baseline_modules = baseline_modules
+        self.baseline = {}
+        for module_name in baseline_modules:
+            self.baseline.update(star_exports(module_name))
+        # keep another synced process, to replace the active one instantly on restart
+        self.use_standby = standby
+        # functions that are expensive or have side effects, text calling them is not previewed
+        self.skip_calls = set(skip_calls)
+        # memory_limit_mb and cpu_limit_sec are enforced by the process itself, rss_limit_mb by recycling it, 0 for no limit
+        self.memory_limit_mb = memory_limit_mb
+        self.cpu_limit_sec = cpu_limit_sec
+        self.rss_limit_mb = rss_limit_mb
+        self.restart_lock = threading.RLock()
+        self.stats = PreviewStats(trace_path)
+        self.start_method = previewer_start_method(preload=baseline_modules)
 
         if debug:
             debug_path = os.path.join(ip.profile_dir.location, 'debug')
@@ -216,78 +851,307 @@ class Previewer():
             self.stdout_path = None
         self.ip.pt_app.style = merge_styles([self.ip.pt_app.style,
             Style([('bottom-toolbar', 'noreverse')])])
+        self.send_lock = threading.Lock()
+        self.request_id = 0
+        self.eval_cost = 0 # moving average of preview evaluation time
+        self.debounce_timer = None
+        self.ns_lock = threading.RLock()
+        # (id, crc): SharedPickle, large buffers shared by all previewer processes
+        self.shared_pickles = {}
         self.start()
 
+    exec_conn = property(lambda self: self.active.exec_conn)
+    ctrl_conn = property(lambda self: self.active.ctrl_conn)
+    ns_conn = property(lambda self: self.active.ns_conn)
+    generation = property(lambda self: self.active.generation)
+
     def start(self):
-        self.exec_conn, exec_conn_c = mp.Pipe()
-        self.ctrl_conn, ctrl_conn_c = mp.Pipe()
-        self.ns_conn, ns_conn_c = mp.Pipe()
-        self.preview_thread = PipeListener(self.exec_conn, self.preview_cb)
-        self.ctrl_thread = PipeListener(self.ctrl_conn, self.ctrl_cb)
-        self.prev_ip_proc = IPythonProcess(exec_conn_c, ctrl_conn_c, ns_conn_c,
-            config=self.config, formatter=self.formatter, debug=self.debug, stdout_path=self.stdout_path)
-        self.push(self.ip.user_ns)
-        self.ip.events.register('pre_run_cell', self.pre_run_cell)
+        self.active = PreviewerProcess(self)
+        self.standby = None
+        self.reset_previews()
+        self.sync()
+        atexit.register(self.release_shared) # before resource tracker complains about leaked blocks
         self.ip.events.register('post_run_cell', self.post_run_cell)
         self.ip.pt_app.default_buffer.on_text_changed.add_handler(self.text_changed_handler)
         self.ip.pt_app.bottom_toolbar = ''
+        self.monitor_stop = threading.Event()
+        threading.Thread(target=self.monitor, args=(self.monitor_stop,), daemon=True, name='previewer_monitor').start()
+
+    def reset_previews(self):
+        self.preview_id = 0 # latest preview request
+        self.answered_id = 0 # latest preview result
+        # (text, generation): result, the generation changes with every cell and push
+        self.preview_cache = OrderedDict()
+        self.previews_sent = {} # request_id: SentPreview
 
     def deinit(self):
-        self.ip.events.unregister('pre_run_cell', self.pre_run_cell)
+        self.monitor_stop.set()
+        if self.debounce_timer is not None:
+            self.debounce_timer.cancel()
         self.ip.events.unregister('post_run_cell', self.post_run_cell)
         self.ip.pt_app.default_buffer.on_text_changed.remove_handler(self.text_changed_handler)
-        self.exec_conn.close()
-        self.ctrl_conn.close()
-        self.ns_conn.close()
-        self.prev_ip_proc.terminate()
+        for proc in self.processes():
+            proc.close()
+        with self.ns_lock:
+            self.active.shared, self.standby = {}, None
+            self.release_shared()
+        atexit.unregister(self.release_shared)
 
-    def restart(self):
-        self.deinit()
-        self.start()
+    def processes(self):
+        return [self.active] + ([self.standby] if self.standby is not None else [])
+
+    def restart(self, proc=None):
+        '''restart active process, unless it is no longer proc (already restarted)'''
+        with self.restart_lock:
+            if proc is not None and proc is not self.active:
+                return
+            self.stats.add('restarted')
+            if self.standby is None:
+                self.deinit()
+                self.start()
+                return
+            with self.ns_lock, self.send_lock:
+                stopped, self.active, self.standby = self.active, self.standby, None
+                self.reset_previews()
+                stopped.close()
+                self.release_shared()
+        # standby is already synced, refresh current preview
+        self.run_cell(self.ip.pt_app.default_buffer.text, assign=False, preview=True)
 
-    def run_cell(self, raw_cell, assign=True, preview=False):
-        self.exec_conn.send((raw_cell, assign, preview))
+    def monitor(self, stop):
+        '''recycle processes that died (e.g. on cpu limit) or grew over rss limit'''
+        while not stop.wait(MONITOR_INTERVAL_SEC):
+            for proc in self.processes():
+                if proc.ip_proc.is_alive() and not (self.rss_limit_mb and proc.rss_mb() > self.rss_limit_mb):
+                    continue
+                if proc is self.active:
+                    self.restart(proc)
+                else:
+                    self.stop_standby(proc)
+                break
+
+    def stop_standby(self, proc):
+        with self.ns_lock:
+            if self.standby is proc:
+                self.standby = None
+                proc.close()
+                self.release_shared()
+
+    def start_standby(self):
+        with self.ns_lock:
+            self.standby = PreviewerProcess(self)
+            self.standby.sync(self.ip.user_ns.copy())
+
+    def run_cell(self, raw_cell, assign=True, preview=False, requested=None):
+        sending = perf_counter()
+        with self.send_lock:
+            self.request_id += 1
+            if not preview:
+                for proc in self.processes():
+                    send(proc.exec_conn, ExecRequest(raw_cell, assign, preview, proc.generation, self.request_id))
+                return
+            send(self.exec_conn, ExecRequest(raw_cell, assign, preview, self.generation, self.request_id))
+            self.previews_sent[self.request_id] = SentPreview(raw_cell, self.generation, requested or sending, sending, perf_counter())
+            self.supersede_preview()
 
-    def pre_run_cell(self, info):
-        # run the code with assignments to align the namespace (no preview)
-        self.run_cell(info.raw_cell, assign=True, preview=False)
+    def supersede_preview(self):
+        if self.answered_id < self.preview_id:
+            # previous preview is still evaluated, and no longer needed
+            send(self.ctrl_conn, ('interrupt', self.request_id))
+        self.preview_id = self.request_id
 
     def post_run_cell(self, result):
-        self.push(self.ip.user_ns)
-        Out = self.ip.user_ns['Out']
-        if len(Out) > 0:
-            Out_last = list(Out)[-1]
-            self.push_kv('Out', Out_last, Out[Out_last])
+        # previewer namespace follows shell's results, cell is re-executed only if needed
+        self.sync(result.info.raw_cell, new_generation=True, pickles=cell_pickles(self.ip, result))
+        if result.info.store_history:
+            self.push_history(result.execution_count)
+        if self.use_standby and self.standby is None and self.active.ready:
+            self.start_standby()
         self.ip.pt_app.bottom_toolbar = ''
         self.ip.pt_app.app.invalidate()
 
-    def ctrl_cb(self, ctrl_msg):
+    def ctrl_cb(self, ctrl_msg, proc=None):
         if ctrl_msg == 'restart':
-            self.restart()
+            if proc is self.standby:
+                self.stop_standby(proc)
+            else:
+                self.restart(proc)
+        elif ctrl_msg[0] == 'mapped' and proc is not None:
+            with self.ns_lock:
+                proc.shared = {var_name: (key, generation) for var_name, (key, generation) in proc.shared.items()
+                               if generation > ctrl_msg[1]}
+                self.release_shared()
 
-    def preview_cb(self, result):
+    def preview_cb(self, preview_msg):
+        received = perf_counter()
+        request_id, result, elapsed, timings = preview_msg
+        self.eval_cost += EVAL_COST_EMA_WEIGHT * (elapsed - self.eval_cost)
+        self.answered_id = request_id
+        with self.send_lock:
+            sent = self.previews_sent.pop(request_id, None)
+            dropped = [self.previews_sent.pop(sent_id) for sent_id in list(self.previews_sent) if sent_id < request_id]
+        for dropped_preview in dropped: # drained by previewer
+            self.stats.add('dropped', dropped_preview.text)
+        if result is None:
+            result = '' # interrupted
+            self.stats.add('timed_out' if timings['timed_out'] else 'cancelled', sent and sent.text)
+        elif sent is not None:
+            self.stats.add('answered', sent.text, {
+                'debounce': sent.sending - sent.requested,
+                'send': sent.sent - sent.sending,
+                'queue': timings['start'] - sent.sent,
+                'transform': timings['transformed'] - timings['start'],
+                'execute': timings['executed'] - timings['transformed'],
+                'format': timings['formatted'] - timings['executed'],
+                'receive': received - timings['sent'],
+                'total': received - sent.requested})
+            self.preview_cache[(sent.text, sent.generation)] = result
+            if len(self.preview_cache) > PREVIEW_CACHE_SIZE:
+                self.preview_cache.popitem(last=False)
+        if request_id < self.preview_id:
+            return # text has changed meanwhile
         self.ip.pt_app.bottom_toolbar = result
         self.ip.pt_app.app.invalidate()
 
-    def text_changed_handler(self, buffer):
-        self.run_cell(buffer.text, assign=False, preview=True)
+    def parse(self, text):
+        '''ast of text as the shell would run it (before ast transformers), None if it doesn't parse'''
+        try:
+            return ast.parse(self.ip.transform_cell(text))
+        except Exception:
+            return None
 
-    def push(self, variables):
-        for var_name, val in variables.copy().items():
-            if var_name in NS_BLOCK_LIST or isinstance(val, ModuleType):
+    def fast_preview(self, tree):
+        '''result of trivial arithmetic evaluated here, same as previewer would show,
+        None if previewer process is needed. tree is parse() of the text'''
+        if tree is None:
+            return None
+        if len(tree.body) == 0:
+            return ''
+        if len(tree.body) > 1 or not isinstance(tree.body[0], ast.Expr) or \
+           not is_fast_expr(tree.body[0].value, self.ip.user_ns):
+            return None
+        try:
+            tree = copy.deepcopy(tree) # transformed in place, and the caller may use it again
+            # ast transformers are not given the chance to unregister themselves on errors, like in transform_ast
+            for transformer in self.ip.ast_transformers:
+                tree = transformer.visit(tree)
+            expr = ast.fix_missing_locations(ast.Expression(tree.body[0].value))
+            return self.formatter(eval(compile(expr, '<preview>', 'eval'), self.ip.user_ns))
+        except Exception:
+            return None # previewer shows errors its own way
+
+    def skip_reason(self, tree):
+        '''why text is not worth previewing (loops, calls to skip, size limited calls of large arguments), None if it is.
+        tree is parse() of the text'''
+        if tree is None:
+            return None
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.For, ast.AsyncFor, ast.While)):
+                return 'loop'
+            if not isinstance(node, ast.Call):
                 continue
-            try:
-                self.ns_conn.send((var_name, val))
-            except Exception as e:
-                if self.debug and var_name != 'Out':
-                    self.ns_conn.send((var_name, repr(e)))
+            name = call_name(node)
+            if name in self.skip_calls:
+                return name
+            if name in PREVIEW_SIZE_LIMITED_CALLS:
+                size = 0
+                for arg in node.args + [keyword.value for keyword in node.keywords]:
+                    for arg_node in ast.walk(arg):
+                        size += 1
+                        if isinstance(arg_node, ast.Name):
+                            size += expr_size(self.ip.user_ns.get(arg_node.id), PREVIEW_MAX_ARGS_SIZE)
+                if size > PREVIEW_MAX_ARGS_SIZE:
+                    return f'large {name}'
+        return None
+
+    def show_local(self, result):
+        '''show result not evaluated by the previewer, any preview being evaluated is no longer needed'''
+        with self.send_lock:
+            self.request_id += 1
+            self.supersede_preview()
+        self.ip.pt_app.bottom_toolbar = result
+        self.ip.pt_app.app.invalidate()
+
+    def text_changed_handler(self, buffer):
+        if self.debounce_timer is not None:
+            self.debounce_timer.cancel()
+        requested = perf_counter()
+        tree = self.parse(buffer.text) # once per keystroke, transforming takes milliseconds
+        result = self.fast_preview(tree)
+        if result is not None:
+            self.show_local(result)
+            self.stats.add('fast', buffer.text, {'total': perf_counter() - requested})
+            return
+        cache_key = (buffer.text, self.generation)
+        if cache_key in self.preview_cache:
+            self.preview_cache.move_to_end(cache_key)
+            self.show_local(self.preview_cache[cache_key])
+            self.stats.add('cached', buffer.text)
+            return
+        reason = self.skip_reason(tree)
+        if reason is not None:
+            self.show_local(PREVIEW_SKIPPED.format(reason))
+            self.stats.add('skipped', buffer.text)
+            return
+        delay = min(self.eval_cost * DEBOUNCE_COST_RATIO, DEBOUNCE_MAX_SEC)
+        if delay < DEBOUNCE_MIN_SEC:
+            self.run_cell(buffer.text, assign=False, preview=True, requested=requested)
+        else:
+            self.debounce_timer = threading.Timer(delay, self.run_cell, args=(buffer.text,),
+                                                  kwargs={'assign': False, 'preview': True, 'requested': requested})
+            self.debounce_timer.daemon = True
+            self.debounce_timer.start()
+
+    def sync(self, cell=None, new_generation=False, pickles=None):
+        '''push variables added, rebound (by identity) or changed in place and deleted since last sync.
+        cell is re-executed in previewer if any of them can't be pickled'''
+        user_ns = self.ip.user_ns.copy()
+        if pickles is None:
+            pickles = CellPickles()
+        with self.ns_lock:
+            for proc in self.processes():
+                proc.sync(user_ns, cell, new_generation, pickles)
+            self.release_shared()
+
+    def push(self, variables, deleted=[], cell=None, new_generation=True):
+        # pickle each variable on its own (so unpicklables are skipped), send all in one message
+        variables = variables.copy()
+        pickles = CellPickles()
+        with self.ns_lock:
+            for proc in self.processes():
+                proc.push(variables, deleted, cell, new_generation, pickles)
+            self.release_shared()
+
+    def release_shared(self):
+        '''unlink shared memory no previewer process is still to map, its mapping outlives the unlink'''
+        with self.ns_lock:
+            in_use = {key for proc in self.processes() for key, generation in proc.shared.values()}
+            for key in [key for key in self.shared_pickles if key not in in_use]:
+                for shm, nbytes in self.shared_pickles.pop(key).blocks:
+                    shm.close()
+                    shm.unlink()
+
+    def push_history(self, count):
+        Out = self.ip.user_ns['Out']
+        entry = HistoryEntry(count, self.ip.user_ns.get(f'_i{count}', ''), count in Out, Out.get(count))
+        with self.ns_lock:
+            for proc in self.processes():
+                try:
+                    proc.ns_conn.send(entry)
+                except OSError:
+                    pass # process died, monitor replaces it
+                except Exception as e:
+                    proc.ns_conn.send(entry._replace(result=repr(e) if self.debug else None))
 
     def push_kv(self, var_name, key, value):
-        try:
-            self.ns_conn.send((var_name, key, value))
-        except Exception as e:
-            if self.debug:
-                self.ns_conn.send((var_name, key, repr(e)))
+        for proc in self.processes():
+            try:
+                proc.ns_conn.send((var_name, key, value))
+            except OSError:
+                pass # process died, monitor replaces it
+            except Exception as e:
+                if self.debug:
+                    proc.ns_conn.send((var_name, key, repr(e)))
 
     def get_stdout(self):
         if self.stdout_path == None:
@@ -295,12 +1159,15 @@ class Previewer():
         with open(self.stdout_path, 'r') as f:
             return f.read()
 
-def load_ipython_extension(ip:IPython.InteractiveShell, config=None, formatter=str, debug=False):
+def load_ipython_extension(ip:IPython.InteractiveShell, config=None, formatter=str, debug=False, baseline_modules=(), standby=True, skip_calls=(),
+                           memory_limit_mb=0, cpu_limit_sec=0, rss_limit_mb=0, trace_path=None):
     if config is None:
         config = ip.config.copy()
     if getattr(ip, 'pt_app', None) is None:
         return
-    ip.previewer = Previewer(ip, config=config, formatter=formatter, debug=debug)
+    ip.previewer = Previewer(ip, config=config, formatter=formatter, debug=debug, baseline_modules=baseline_modules, standby=standby, skip_calls=skip_calls,
+                             memory_limit_mb=memory_limit_mb, cpu_limit_sec=cpu_limit_sec, rss_limit_mb=rss_limit_mb,
+                             trace_path=trace_path)
 
 def unload_ipython_extension(ip:IPython.InteractiveShell):
     if getattr(ip, 'pt_app', None) is None:
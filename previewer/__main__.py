@@ -1,6 +1,6 @@
 import sys
 import multiprocessing as mp
-from previewer import IPythonProcess
+from previewer import IPythonProcess, previewer_start_method
 
 # interactive previewer session for debugging
 if __name__ == "__main__":
@@ -8,7 +8,7 @@ if __name__ == "__main__":
     ctrl_conn, ctrl_conn_c = mp.Pipe()
     ns_conn, ns_conn_c = mp.Pipe()
     sys.stdin.close()
-    proc = IPythonProcess(exec_conn_c, ctrl_conn_c, ns_conn_c, interactive=True)
+    proc = IPythonProcess(exec_conn_c, ctrl_conn_c, ns_conn_c, interactive=True, start_method=previewer_start_method())
     try:
         proc.join()
     except KeyboardInterrupt: